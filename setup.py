@@ -31,6 +31,8 @@ setuptools.setup(
   download_url='',
   keywords=["machine learning delivery", "mobile deployment", "model versioning"],
   install_requires=REQS,
+  extras_require={"http2": ["httpx[http2]"], "delta": ["numpy"]},
+  entry_points={"console_scripts": ["skafos=skafos.cli:main"]},
   include_package_data=True,
   tests_require=["pytest"],
   setup_requires=["pytest-runner"],
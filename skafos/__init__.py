@@ -1,4 +1,5 @@
-from .utilities import get_version, summary
+from .utilities import get_version, summary, iter_summary
+from .index import MetadataIndex
 
 # Define package modules to expose
-__all__ = ['models', 'exceptions']
+__all__ = ['models', 'exceptions', 'index']
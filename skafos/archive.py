@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import shutil
+import struct
+import hashlib
+import logging
+import zipfile
+import threading
+from stat import S_ISDIR
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .exceptions import InvalidParamError
+from .integrity import Digests, HashingWriter, file_digests
+
+
+DEFAULT_CACHE_SIZE = 10 * 1024**3
+# Directories listed and files hashed at once; scanning waits on I/O, so this is well above the core count
+DEFAULT_SCAN_WORKERS = 16
+# Digests computed while an archive is written, sha256 to identify it and md5 for Content-MD5 on upload
+ARCHIVE_DIGESTS = ("sha256", "md5")
+logger = logging.getLogger(name="skafos.archive")
+
+# One file going into an upload archive
+ManifestEntry = namedtuple("ManifestEntry", ["path", "arcname", "size", "mtime_ns", "sha256", "mode"],
+                           defaults=(None,))
+
+
+def _arcname(path):
+    # Same archive name zipfile.ZipFile.write picks for a path
+    arcname = os.path.normpath(os.path.splitdrive(path)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _scan_input(path):
+    # Validate one file or directory passed in for upload, describing it if it's a file
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise InvalidParamError("{} file doesn't exist. Can't upload to Skafos.".format(path))
+    if S_ISDIR(stat.st_mode):
+        return None
+    if path.endswith(".zip") and not zipfile.is_zipfile(path):
+        raise InvalidParamError("{} is an invalid zipfile. Can't upload to Skafos.".format(path))
+    return ManifestEntry(path, _arcname(path), stat.st_size, stat.st_mtime_ns, None, stat.st_mode)
+
+
+def _scan_dir(path):
+    # List one directory in a single scandir pass: its files with their stats, and the subdirectories to descend into
+    try:
+        entries = list(os.scandir(path))
+    except OSError as err:
+        # os.walk skips directories it can't list, so keep doing that, but say so
+        logger.warning("Skipping {}: {}".format(path, err))
+        return [], []
+    files, dirs = [], []
+    for entry in entries:
+        if entry.is_dir():
+            # Like os.walk, symlinked directories aren't descended into
+            if not entry.is_symlink():
+                dirs.append(entry.path)
+        else:
+            stat = entry.stat()
+            files.append(ManifestEntry(entry.path, _arcname(entry.path), stat.st_size, stat.st_mtime_ns, None,
+                                       stat.st_mode))
+    return files, dirs
+
+
+def _walk_order(listings, top):
+    # Lay the directory listings out in the top-down order os.walk yields them
+    manifest = []
+    stack = [top]
+    while stack:
+        files, dirs = listings[stack.pop()]
+        manifest.extend(files)
+        stack.extend(reversed(dirs))
+    return manifest
+
+
+def scan(filelist, workers=DEFAULT_SCAN_WORKERS):
+    """Validate the files and directories going into an upload archive and describe each file in it, in a
+    single pass. Directories are listed concurrently, since on network filesystems the time goes to waiting
+    on metadata calls rather than to the calls themselves."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="skafos-scan") as executor:
+        inputs = [(path, executor.submit(_scan_input, path)) for path in filelist]
+        tops = [path for path, future in inputs if future.result() is None]
+        listings = {}
+        pending = {executor.submit(_scan_dir, path): path for path in set(tops)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listings[path] = future.result()
+                for subdir in listings[path][1]:
+                    pending[executor.submit(_scan_dir, subdir)] = subdir
+    manifest = []
+    for path, future in inputs:
+        entry = future.result()
+        manifest.extend([entry] if entry is not None else _walk_order(listings, path))
+    return manifest
+
+
+def hash_manifest(manifest, workers=DEFAULT_SCAN_WORKERS):
+    """Fill in the SHA-256 of every file in a manifest, hashing files concurrently."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="skafos-scan") as executor:
+        hashes = executor.map(_file_hash, [entry.path for entry in manifest])
+        return [entry._replace(sha256=sha256) for entry, sha256 in zip(manifest, hashes)]
+
+
+def build_manifest(filelist, hash_files=False):
+    """Walk the files and directories going into an upload archive and describe each file in it."""
+    manifest = scan(filelist)
+    return hash_manifest(manifest) if hash_files else manifest
+
+
+def manifest_digest(manifest):
+    """Identify an input tree by its manifest."""
+    digest = hashlib.sha256()
+    for entry in manifest:
+        key = [entry.arcname, entry.size, entry.sha256] if entry.sha256 else \
+            [os.path.abspath(entry.path), entry.arcname, entry.size, entry.mtime_ns]
+        digest.update(json.dumps(key).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _member_key(entry):
+    # Content hashes make members reusable across paths; otherwise trust path, size, and mtime
+    if entry.sha256:
+        key = [entry.arcname, entry.sha256]
+    else:
+        key = [os.path.abspath(entry.path), entry.arcname, entry.size, entry.mtime_ns]
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def _member_data_offset(fp, zinfo):
+    # Compressed data starts right after the member's local file header
+    fp.seek(zinfo.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return zinfo.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+# ZipFile internals _write_raw_member relies on. They are private, so check for them rather than assume them.
+_SPLICE_ATTRIBUTES = ("fp", "start_dir", "filelist", "NameToInfo", "_seekable", "_writecheck", "_didModify")
+
+
+def _can_splice(skazip):
+    # Whether this Python's ZipFile still has the internals needed to append already-compressed members
+    return all(hasattr(skazip, name) for name in _SPLICE_ATTRIBUTES) and hasattr(zipfile.ZipInfo, "FileHeader")
+
+
+def _write_raw_member(skazip, meta, data):
+    # Append an already-compressed member, following what ZipFile.write does around its compressor
+    zinfo = zipfile.ZipInfo(meta["arcname"], tuple(meta["date_time"]))
+    zinfo.compress_type = meta["compress_type"]
+    zinfo.file_size = meta["file_size"]
+    zinfo.compress_size = meta["compress_size"]
+    zinfo.CRC = meta["crc"]
+    zinfo.external_attr = meta["external_attr"]
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if skazip._seekable:
+        skazip.fp.seek(skazip.start_dir)
+    zinfo.header_offset = skazip.fp.tell()
+    skazip._writecheck(zinfo)
+    skazip._didModify = True
+    skazip.fp.write(zinfo.FileHeader(zip64))
+    shutil.copyfileobj(data, skazip.fp, 1024*1024)
+    skazip.filelist.append(zinfo)
+    skazip.NameToInfo[zinfo.filename] = zinfo
+    skazip.start_dir = skazip.fp.tell()
+
+
+def _write_member(skazip, entry):
+    # Compress a file into the archive like ZipFile.write, but from the stat taken when it was scanned
+    if entry.mode is None:
+        skazip.write(entry.path, entry.arcname)
+        return
+    zinfo = zipfile.ZipInfo(entry.arcname, time.localtime(entry.mtime_ns / 1e9)[:6])
+    zinfo.external_attr = (entry.mode & 0xFFFF) << 16
+    zinfo.file_size = entry.size
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    with open(entry.path, "rb") as src, skazip.open(zinfo, "w") as dest:
+        shutil.copyfileobj(src, dest, 1024*1024)
+
+
+class ArchiveCache(object):
+    """On-disk cache of upload archives keyed by manifest, and of their compressed members."""
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE, hash_files=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_files = hash_files
+        self._archives = os.path.join(directory, "archives")
+        self._members = os.path.join(directory, "members")
+        os.makedirs(self._archives, exist_ok=True)
+        os.makedirs(self._members, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _tmp_path(self, path):
+        return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+    def _member(self, entry):
+        # Return the cached metadata and open compressed data for a member, or None on a miss
+        path = os.path.join(self._members, _member_key(entry))
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            data = open(path, "rb")
+        except (OSError, ValueError):
+            return None
+        # Touch both files, so pruning doesn't evict the metadata of a member that is still in use
+        os.utime(path)
+        os.utime(path + ".json")
+        meta["arcname"] = entry.arcname
+        return meta, data
+
+    def _store_members(self, archive_path, entries):
+        # Copy freshly compressed members out of a finished archive so later archives can reuse them
+        with zipfile.ZipFile(archive_path) as skazip, open(archive_path, "rb") as fp:
+            for entry in entries:
+                zinfo = skazip.getinfo(entry.arcname)
+                path = os.path.join(self._members, _member_key(entry))
+                fp.seek(_member_data_offset(fp, zinfo))
+                with open(self._tmp_path(path), "wb") as f:
+                    remaining = zinfo.compress_size
+                    while remaining:
+                        chunk = fp.read(min(remaining, 1024*1024))
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                os.replace(self._tmp_path(path), path)
+                meta = {
+                    "date_time": zinfo.date_time,
+                    "compress_type": zinfo.compress_type,
+                    "file_size": zinfo.file_size,
+                    "compress_size": zinfo.compress_size,
+                    "crc": zinfo.CRC,
+                    "external_attr": zinfo.external_attr
+                }
+                with open(self._tmp_path(path + ".json"), "w") as f:
+                    json.dump(meta, f)
+                os.replace(self._tmp_path(path + ".json"), path + ".json")
+
+    def archive(self, manifest):
+        """Return a path to an archive of the manifest and its digests, reusing a cached archive of the
+        same tree or splicing in cached members for unchanged files."""
+        path = os.path.join(self._archives, manifest_digest(manifest) + ".zip")
+        if os.path.exists(path):
+            logger.debug("Reusing cached archive {}".format(path))
+            os.utime(path)
+            if os.path.exists(path + ".digests.json"):
+                os.utime(path + ".digests.json")
+            return path, self._digests(path)
+        compressed = []
+        try:
+            with open(self._tmp_path(path), "wb") as f:
+                writer = HashingWriter(f, Digests(ARCHIVE_DIGESTS))
+                self._write(writer, manifest, compressed)
+            logger.debug("Spliced {} cached members into archive".format(len(manifest) - len(compressed)))
+            self._store_members(self._tmp_path(path), compressed)
+            self._store_digests(path, writer.digests)
+            os.replace(self._tmp_path(path), path)
+        finally:
+            if os.path.exists(self._tmp_path(path)):
+                os.remove(self._tmp_path(path))
+        self.prune(keep=path)
+        return path, writer.digests
+
+    def _write(self, fp, manifest, compressed):
+        # Splice cached members in and compress the rest, noting which entries were compressed
+        with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as skazip:
+            splice = _can_splice(skazip)
+            if not splice:
+                logger.warning("This Python's zipfile module can't splice cached members, compressing every file")
+            for entry in manifest:
+                member = self._member(entry) if splice else None
+                if member:
+                    meta, data = member
+                    with data:
+                        _write_raw_member(skazip, meta, data)
+                else:
+                    _write_member(skazip, entry)
+                    compressed.append(entry)
+
+    def _digests(self, path):
+        # Digests stored when the archive was built, or recomputed if they were pruned
+        try:
+            with open(path + ".digests.json") as f:
+                return Digests.from_dict(json.load(f))
+        except (OSError, ValueError):
+            digests = file_digests(path, ARCHIVE_DIGESTS)
+            self._store_digests(path, digests)
+            return digests
+
+    def _store_digests(self, path, digests):
+        with open(self._tmp_path(path + ".digests.json"), "w") as f:
+            json.dump(digests.to_dict(), f)
+        os.replace(self._tmp_path(path + ".digests.json"), path + ".digests.json")
+
+    def prune(self, keep=None):
+        """Remove least recently used archives and members until the cache fits in `max_size`."""
+        if not self.max_size:
+            return
+        with self._lock:
+            files = []
+            for folder in (self._archives, self._members):
+                for name in os.listdir(folder):
+                    path = os.path.join(folder, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_size:
+                    break
+                if path == keep or path.endswith(".tmp"):
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+def write_archive(path, manifest):
+    """Zip every file in the manifest into a new archive at `path`, in a single streaming pass.
+    Returns the path and the archive's digests."""
+    with open(path, "wb") as f:
+        writer = HashingWriter(f, Digests(ARCHIVE_DIGESTS))
+        with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as skazip:
+            for entry in manifest:
+                _write_member(skazip, entry)
+    return path, writer.digests
+
+
+def _cache_from_env():
+    directory = os.getenv("SKAFOS_ARCHIVE_CACHE_DIR")
+    if not directory:
+        return None
+    max_size = os.getenv("SKAFOS_ARCHIVE_CACHE_SIZE")
+    return ArchiveCache(directory, max_size=int(max_size) if max_size else DEFAULT_CACHE_SIZE)
+
+
+archive_cache = _cache_from_env()
+
+
+def configure(directory=None, max_size=DEFAULT_CACHE_SIZE, hash_files=False):
+    r"""
+    Enable the upload archive cache. When enabled, re-uploading an unchanged set of files reuses the archive built
+    last time, and files that haven't changed are spliced into new archives without being compressed again.
+    The cache can also be enabled from the environment with `SKAFOS_ARCHIVE_CACHE_DIR` and
+    `SKAFOS_ARCHIVE_CACHE_SIZE`.
+
+    :param directory:
+        Directory to keep cached archives in. Pass None to disable the cache.
+    :type directory:
+        str or None
+    :param max_size:
+        Maximum number of bytes to keep in the cache. Least recently used entries are removed first. Defaults to 10GB.
+    :type max_size:
+        int
+    :param hash_files:
+        If True, identify files by a SHA-256 of their contents instead of their path, size, and modification
+        time. Slower, but survives touched or copied files. False by default.
+    :type hash_files:
+        boolean
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import archive
+
+       archive.configure(directory="/var/cache/skafos")
+
+    """
+    global archive_cache
+    archive_cache = ArchiveCache(directory, max_size=max_size, hash_files=hash_files) if directory else None
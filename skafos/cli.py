@@ -0,0 +1,55 @@
+import argparse
+import logging
+
+from . import delta, peercache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="skafos", description="Skafos SDK command line tools.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve = subparsers.add_parser(
+        "cache-serve",
+        help="Serve model version downloads to the local network from a shared cache."
+    )
+    serve.add_argument("--host", default="0.0.0.0", help="Interface to listen on (default: all interfaces).")
+    serve.add_argument("--port", type=int, default=peercache.DEFAULT_PORT, help="Port to listen on (default: 8950).")
+    serve.add_argument("--store", default=peercache.DEFAULT_STORE_DIR, help="Directory to keep cached versions in.")
+    serve.add_argument("--max-size", type=int, default=peercache.DEFAULT_STORE_SIZE,
+                       help="Maximum bytes to keep in the store (default: 50GB).")
+    serve.add_argument("--upstream", default=peercache.DOWNLOAD_BASE_URL, help="Download endpoint to fetch from.")
+    serve.add_argument("--certfile", help="PEM certificate chain to serve HTTPS with. Recommended, since clients send "
+                                          "their API token.")
+    serve.add_argument("--keyfile", help="Private key for --certfile, if it isn't in the same file.")
+
+    chunks = subparsers.add_parser(
+        "chunk-serve",
+        help="Serve a local chunk store for delta uploads, for trying them out and offline testing."
+    )
+    chunks.add_argument("--host", default="127.0.0.1", help="Interface to listen on (default: localhost).")
+    chunks.add_argument("--port", type=int, default=delta.DEFAULT_PORT, help="Port to listen on (default: 8951).")
+    chunks.add_argument("--store", required=True, help="Directory to keep chunks in.")
+
+    args = parser.parse_args(argv)
+    if args.command == "cache-serve":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+        peercache.serve(
+            host=args.host,
+            port=args.port,
+            directory=args.store,
+            max_size=args.max_size,
+            upstream=args.upstream,
+            certfile=args.certfile,
+            keyfile=args.keyfile
+        )
+        return 0
+    if args.command == "chunk-serve":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+        delta.serve(args.store, host=args.host, port=args.port)
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,535 @@
+import io
+import os
+import json
+import math
+import zlib
+import random
+import sqlite3
+import hashlib
+import logging
+import zipfile
+import threading
+import time
+from functools import partial
+from contextlib import nullcontext
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from . import ratelimit
+from .http import _http_request, DEFAULT_TRANSFER_TIMEOUT
+from .exceptions import DownloadFailedError, InvalidParamError
+
+try:
+    import numpy as _np
+except ImportError:  # Optional, only needed for fast chunking
+    _np = None
+
+
+MANIFEST_FORMAT = "skafos-delta/1"
+DEFAULT_MIN_CHUNK = 256 * 1024
+DEFAULT_AVG_CHUNK = 1024 * 1024
+DEFAULT_MAX_CHUNK = 4 * 1024 * 1024
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".skafos", "chunks.db")
+# Chunks the index recorded longer ago than this are checked against the store again
+DEFAULT_INDEX_MAX_AGE = 7 * 24 * 60 * 60
+# Bytes hashed per vectorized step when looking for a chunk boundary
+SCAN_BLOCK = 64 * 1024
+DEFAULT_PORT = 8951
+# Chunks checked against the store per round trip, and chunk transfers kept in flight
+BATCH_SIZE = 64
+MAX_WORKERS = 8
+logger = logging.getLogger(name="skafos.delta")
+
+# Every delta manifest starts with these bytes, which is how a download is told apart from a zip archive
+_MAGIC = json.dumps({"format": MANIFEST_FORMAT})[:-1].encode("utf-8")
+_MASK64 = (1 << 64) - 1
+# Gear table for the rolling hash. Fixed, so every client cuts identical content at identical points.
+_rng = random.Random(0x5CAF05)
+_GEAR = [_rng.getrandbits(64) for _ in range(256)]
+del _rng
+_GEAR_ARRAY = _np.array(_GEAR, dtype=_np.uint64) if _np is not None else None
+
+
+def _cut_point(data, min_size, max_size, mask):
+    # Gear hash over the bytes past min_size; cut where the masked top bits of the hash are all zero.
+    # Each byte shifts out of the top bit after 64 steps, so only the last 64 bytes decide a cut.
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    gear = _GEAR
+    h = 0
+    for i in range(max(0, min_size - 64), min_size):
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+    for i in range(min_size, end):
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        if not h & mask:
+            return i + 1
+    return end
+
+
+def _window_hashes(data, start, stop):
+    # Gear hash of the 64 bytes ending at each position in [start, stop), built by doubling the window from
+    # one byte to 64: H_2w(i) = H_w(i) + (H_w(i - w) << w). Positions before the start of data count as zero.
+    lo = max(0, start - 63)
+    h = _GEAR_ARRAY[_np.frombuffer(data, dtype=_np.uint8, count=stop - lo, offset=lo)]
+    width = 1
+    while width < 64:
+        h[width:] += h[:-width] << _np.uint64(width)
+        width *= 2
+    return h[start - lo:]
+
+
+def _cut_point_vectorized(data, min_size, max_size, mask):
+    # Same cut points as _cut_point, hashing SCAN_BLOCK bytes at a time with numpy
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    mask = _np.uint64(mask)
+    for start in range(min_size, end, SCAN_BLOCK):
+        stop = min(start + SCAN_BLOCK, end)
+        cuts = _np.flatnonzero((_window_hashes(data, start, stop) & mask) == 0)
+        if cuts.size:
+            return start + int(cuts[0]) + 1
+    return end
+
+
+def iter_chunks(fp, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK, max_size=DEFAULT_MAX_CHUNK):
+    """Split a binary stream into content-defined chunks. Chunk boundaries depend only on nearby bytes,
+    so an edit in one place leaves the chunks everywhere else unchanged."""
+    bits = max(1, round(math.log2(max(2, avg_size - min_size))))
+    mask = ((1 << bits) - 1) << (64 - bits)
+    cut_point = _cut_point_vectorized if _np is not None else _cut_point
+    buf = b""
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = fp.read(max_size)
+            eof = not data
+            buf += data
+        if not buf:
+            return
+        cut = cut_point(buf, min_size, max_size, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+class ChunkIndex(object):
+    """Local SQLite record of the chunks each chunk store is known to have, so they aren't checked again.
+    Entries older than `max_age` seconds are ignored, so chunks the store has since lost are uploaded again."""
+
+    def __init__(self, path=None, max_age=DEFAULT_INDEX_MAX_AGE):
+        if not path:
+            path = os.getenv("SKAFOS_CHUNK_INDEX_PATH", DEFAULT_INDEX_PATH)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (store TEXT NOT NULL, digest TEXT NOT NULL, "
+                "added REAL NOT NULL DEFAULT 0, PRIMARY KEY (store, digest))"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")]
+            if "added" not in columns:
+                # Indexes written before entries expired; their entries count as stale
+                self._conn.execute("ALTER TABLE chunks ADD COLUMN added REAL NOT NULL DEFAULT 0")
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def known(self, store, digests):
+        """Return the subset of `digests` recorded for the store within the last `max_age` seconds."""
+        digests = list(digests)
+        if not digests:
+            return set()
+        statement = "SELECT digest FROM chunks WHERE store = ? AND added >= ? AND digest IN ({})".format(
+            ", ".join("?" * len(digests))
+        )
+        with self._lock:
+            return {row[0] for row in self._conn.execute(statement, [store, time.time() - self.max_age] + digests)}
+
+    def add(self, store, digests):
+        """Record that the store has these chunks, refreshing entries already recorded."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (store, digest, added) VALUES (?, ?, ?)",
+                [(store, digest, now) for digest in digests]
+            )
+            self._conn.execute("DELETE FROM chunks WHERE store = ? AND added < ?", (store, now - self.max_age))
+
+
+class ChunkStore(object):
+    """Chunk storage for delta uploads, reached over HTTP. Chunks are zlib compressed and addressed by the
+    SHA-256 of their uncompressed bytes: `GET`/`PUT {url}/chunks/<sha256>` transfer a chunk, and
+    `POST {url}/chunks/missing` with a JSON list of digests returns the ones the store doesn't have."""
+
+    def __init__(self, url, index=None, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK,
+                 max_size=DEFAULT_MAX_CHUNK):
+        if not 0 < min_size < avg_size < max_size:
+            raise InvalidParamError("Chunk sizes must satisfy 0 < min_size < avg_size < max_size.")
+        self.url = url.rstrip("/")
+        self.index = index if index is not None else ChunkIndex()
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+    def chunks(self, fp):
+        return iter_chunks(fp, min_size=self.min_size, avg_size=self.avg_size, max_size=self.max_size)
+
+    def missing(self, digests, api_token):
+        """Return the digests the store doesn't have, asking it only about chunks not in the local index."""
+        known = self.index.known(self.url, digests)
+        unknown = [digest for digest in digests if digest not in known]
+        if not unknown:
+            return []
+        missing = _http_request(
+            method="POST",
+            url=self.url + "/chunks/missing",
+            api_token=api_token,
+            payload=json.dumps(unknown),
+            kind=ratelimit.CHUNK
+        ).json()
+        self.index.add(self.url, set(unknown) - set(missing))
+        return missing
+
+    def put(self, digest, data, api_token):
+        _http_request(
+            method="PUT",
+            url=self.url + "/chunks/" + digest,
+            api_token=api_token,
+            header={"Content-Type": "application/octet-stream"},
+            timeout=DEFAULT_TRANSFER_TIMEOUT,
+            payload=zlib.compress(data),
+            kind=ratelimit.CHUNK
+        )
+
+    def get(self, digest, api_token):
+        try:
+            res = _http_request(
+                method="GET",
+                url=self.url + "/chunks/" + digest,
+                api_token=api_token,
+                timeout=DEFAULT_TRANSFER_TIMEOUT,
+                kind=ratelimit.CHUNK
+            )
+        except InvalidParamError:
+            raise DownloadFailedError("Model version download failed. Chunk {} is missing from the chunk store.".format(digest))
+        try:
+            data = zlib.decompress(res.content)
+        except zlib.error:
+            data = None
+        if data is None or hashlib.sha256(data).hexdigest() != digest:
+            raise DownloadFailedError("Model version download failed integrity check (chunk {} is corrupt).".format(digest))
+        return data
+
+
+def file_members(manifest):
+    """Zip member info and an opener for each file in an archive manifest."""
+    for entry in manifest:
+        yield zipfile.ZipInfo.from_file(entry.path, entry.arcname), partial(open, entry.path, "rb")
+
+
+def buffer_members(buffers):
+    """Zip member info and an opener for each in-memory buffer, given a mapping of archive names to bytes or
+    readable file objects. File objects are read from their current position and left open."""
+    date_time = time.localtime(time.time())[:6]
+    for name, buffer in buffers.items():
+        zinfo = zipfile.ZipInfo(name, date_time)
+        zinfo.external_attr = 0o600 << 16
+        if hasattr(buffer, "read"):
+            yield zinfo, partial(nullcontext, buffer)
+        else:
+            zinfo.file_size = memoryview(buffer).nbytes
+            yield zinfo, partial(io.BytesIO, buffer)
+
+
+def zip_members(path):
+    """Zip member info and an opener for each member of an existing zip archive, given its path or a file
+    object. Members are chunked uncompressed, so unchanged members dedupe even though the archive's compressed
+    bytes differ."""
+    with zipfile.ZipFile(path) as skazip:
+        for zinfo in skazip.infolist():
+            yield zinfo, partial(skazip.open, zinfo)
+
+
+def _flush(store, batch, api_token, executor):
+    # Upload the batched chunks the store is missing; returns the number of bytes uploaded
+    missing = store.missing(list(batch), api_token)
+    list(executor.map(lambda digest: store.put(digest, batch[digest], api_token), missing))
+    store.index.add(store.url, missing)
+    uploaded = sum(len(batch[digest]) for digest in missing)
+    batch.clear()
+    return uploaded
+
+
+def pack(members, store, api_token):
+    """Chunk every member, upload the chunks the store doesn't have yet, and return the delta manifest
+    describing how to put the archive back together."""
+    manifest = {"format": MANIFEST_FORMAT, "members": []}
+    batch = {}
+    total = uploaded = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="skafos-delta") as executor:
+        for zinfo, open_member in members:
+            chunks = []
+            manifest["members"].append({
+                "arcname": zinfo.filename,
+                "date_time": zinfo.date_time,
+                "external_attr": zinfo.external_attr,
+                "size": zinfo.file_size,
+                "chunks": chunks
+            })
+            if zinfo.is_dir():
+                continue
+            size = 0
+            with open_member() as fp:
+                for chunk in store.chunks(fp):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    chunks.append([digest, len(chunk)])
+                    batch[digest] = chunk
+                    size += len(chunk)
+                    if len(batch) >= BATCH_SIZE:
+                        uploaded += _flush(store, batch, api_token, executor)
+            # The bytes actually read, since file objects don't know their size up front
+            manifest["members"][-1]["size"] = size
+            total += size
+        uploaded += _flush(store, batch, api_token, executor)
+    logger.info("Uploaded {} of {} bytes as new chunks".format(uploaded, total))
+    return json.dumps(manifest).encode("utf-8")
+
+
+def is_manifest(path):
+    """Check whether a downloaded file is a delta manifest rather than a zip archive."""
+    with open(path, "rb") as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def _fetch_chunks(store, digests, api_token, executor):
+    # Yield chunks in order, keeping up to MAX_WORKERS fetches in flight
+    pending = deque()
+    for digest in digests:
+        pending.append(executor.submit(store.get, digest, api_token))
+        if len(pending) >= MAX_WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def expand(path, store, api_token):
+    """Replace a downloaded delta manifest with the zip archive it describes."""
+    with open(path, "rb") as f:
+        manifest = json.loads(f.read().decode("utf-8"))
+    tmp_path = "{}.{}.delta.tmp".format(path, os.getpid())
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="skafos-delta") as executor, \
+                zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as skazip:
+            for member in manifest["members"]:
+                zinfo = zipfile.ZipInfo(member["arcname"], tuple(member["date_time"]))
+                zinfo.external_attr = member["external_attr"]
+                if zinfo.is_dir():
+                    skazip.writestr(zinfo, b"")
+                    continue
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                digests = [digest for digest, _ in member["chunks"]]
+                with skazip.open(zinfo, "w", force_zip64=member["size"] > zipfile.ZIP64_LIMIT) as out:
+                    for data in _fetch_chunks(store, digests, api_token, executor):
+                        out.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _is_digest(value):
+    # Only 64 lowercase hex characters name a chunk, so nothing else can reach the filesystem
+    return isinstance(value, str) and len(value) == 64 and not value.strip("0123456789abcdef")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Minimal chunk store over a directory, standing in for real chunk storage
+
+    def _chunk_path(self):
+        digest = self.path[len("/chunks/"):]
+        if not self.path.startswith("/chunks/") or not _is_digest(digest):
+            return None
+        return os.path.join(self.server.directory, digest)
+
+    def _authorized(self):
+        if not self.headers.get("X-API-TOKEN"):
+            self.send_error(401, "Missing Skafos API Token")
+            return False
+        return True
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, body, content_type="application/octet-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self._chunk_path()
+        if not self._authorized():
+            return
+        if path is None or not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            self._reply(f.read())
+
+    def do_PUT(self):
+        path = self._chunk_path()
+        if not self._authorized():
+            return
+        if path is None:
+            self.send_error(404)
+            return
+        body = self._body()
+        try:
+            data = zlib.decompress(body)
+        except zlib.error:
+            data = None
+        # Only store chunks whose content matches their address, so the store can't be poisoned
+        if data is None or hashlib.sha256(data).hexdigest() != os.path.basename(path):
+            self.send_error(400, "Chunk does not match its digest")
+            return
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        self._reply(b"")
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != "/chunks/missing":
+            self.send_error(404)
+            return
+        try:
+            digests = json.loads(self._body().decode("utf-8"))
+        except ValueError:
+            digests = None
+        if not isinstance(digests, list) or not all(_is_digest(d) for d in digests):
+            self.send_error(400, "Expected a JSON list of SHA-256 digests")
+            return
+        missing = [d for d in digests if not os.path.exists(os.path.join(self.server.directory, d))]
+        self._reply(json.dumps(missing).encode("utf-8"), content_type="application/json")
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(directory, host="127.0.0.1", port=DEFAULT_PORT):
+    """Create a local stand-in chunk store server. Call `serve_forever()` on it to start serving."""
+    os.makedirs(directory, exist_ok=True)
+    server = _Server((host, port), _Handler)
+    server.directory = directory
+    return server
+
+
+def serve(directory, host="127.0.0.1", port=DEFAULT_PORT):
+    r"""
+    Run a local chunk store for delta uploads, backed by a directory. This is what `skafos chunk-serve` runs.
+    It's meant for trying delta uploads out and for offline testing, not as production storage.
+
+    :param directory:
+        Directory to keep chunks in.
+    :type directory:
+        str
+    :param host:
+        Interface to listen on. Defaults to localhost only.
+    :type host:
+        str
+    :param port:
+        Port to listen on. Defaults to 8951.
+    :type port:
+        int
+    """
+    server = make_server(directory, host=host, port=port)
+    logger.info("Serving Skafos chunk store on {}:{}".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _store_from_env():
+    url = os.getenv("SKAFOS_CHUNK_STORE_URL")
+    return ChunkStore(url) if url else None
+
+
+# Chunk store delta uploads go to, if delta uploads are enabled
+chunk_store = _store_from_env()
+
+
+def configure(url=None, index_path=None, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK,
+              max_size=DEFAULT_MAX_CHUNK, index_max_age=DEFAULT_INDEX_MAX_AGE):
+    r"""
+    Enable delta uploads. Model files are split into content-defined chunks, and :func:`skafos.models.upload_version`
+    only uploads chunks the chunk store doesn't already have, plus a small manifest that is stored as the model
+    version. :func:`skafos.models.fetch_version` reassembles the zip archive from the chunk store. Successive
+    versions that differ in a few layers only upload the changed chunks. Disabled by default, and can also be
+    enabled from the environment with `SKAFOS_CHUNK_STORE_URL`.
+
+    .. note:: Versions uploaded as deltas can only be downloaded with the same chunk store configured.
+
+    :param url:
+        Base URL of the chunk store, for example "http://chunks.local:8951" (see `skafos chunk-serve`). Pass None to
+        upload whole archives.
+    :type url:
+        str or None
+    :param index_path:
+        *Optional*. Location of the local SQLite index of chunks already uploaded. Checks environment for
+        'SKAFOS_CHUNK_INDEX_PATH' if not passed, otherwise defaults to `~/.skafos/chunks.db`.
+    :type index_path:
+        str
+    :param index_max_age:
+        *Optional*. Seconds the local index trusts that the chunk store still has a chunk before asking it
+        again. Defaults to a week.
+    :type index_max_age:
+        float
+    :param min_size:
+        Smallest chunk in bytes. Defaults to 256KB.
+    :type min_size:
+        int
+    :param avg_size:
+        Target average chunk size in bytes. Defaults to 1MB.
+    :type avg_size:
+        int
+    :param max_size:
+        Largest chunk in bytes. Defaults to 4MB.
+    :type max_size:
+        int
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import delta
+
+       delta.configure(url="http://chunks.local:8951")
+
+    :raises:
+        * `InvalidParamError` - if the chunk sizes are not increasing.
+
+    """
+    global chunk_store
+    if url is None:
+        chunk_store = None
+        return
+    chunk_store = ChunkStore(url, index=ChunkIndex(index_path, max_age=index_max_age), min_size=min_size, avg_size=avg_size,
+                             max_size=max_size)
@@ -0,0 +1,167 @@
+import time
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_MIN_DELAY = 0.01
+DEFAULT_MAX_EXTRA_LOAD = 0.05
+# Latencies observed before hedging kicks in, and how many recent ones are kept per host
+MIN_SAMPLES = 20
+WINDOW = 1000
+# Seconds of recent traffic the max_extra_load budget is measured over
+BUDGET_WINDOW = 60
+logger = logging.getLogger(name="skafos.hedging")
+
+
+class Hedger(object):
+    """Send a second identical request when the first is slower than recent calls to the same host,
+    and use whichever response arrives first."""
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, min_delay=DEFAULT_MIN_DELAY,
+                 max_extra_load=DEFAULT_MAX_EXTRA_LOAD, max_workers=32):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_extra_load = max_extra_load
+        self.max_workers = max_workers
+        self._latencies = {}
+        self._requests = deque()
+        self._hedges = deque()
+        self._hedges_running = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="skafos-hedge")
+
+    def delay(self, host):
+        """How long to wait on the first request before hedging, or None while there's too little history."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(host, ()))
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def _record(self, host, latency):
+        with self._lock:
+            self._latencies.setdefault(host, deque(maxlen=WINDOW)).append(latency)
+
+    def _count_request(self, now):
+        with self._lock:
+            self._requests.append(now)
+            self._expire(now)
+
+    def _expire(self, now):
+        # Only requests and hedges from the last BUDGET_WINDOW seconds count towards the budget. Call with the lock held.
+        for sent in (self._requests, self._hedges):
+            while sent and sent[0] < now - BUDGET_WINDOW:
+                sent.popleft()
+
+    def _allow_hedge(self):
+        # Keep recent hedged requests under max_extra_load of recent requests, and never queue a hedge
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if self._hedges_running < self.max_workers and len(self._hedges) < self.max_extra_load * len(self._requests):
+                self._hedges.append(now)
+                self._hedges_running += 1
+                return True
+            return False
+
+    def _hedge(self, send):
+        try:
+            return send()
+        finally:
+            with self._lock:
+                self._hedges_running -= 1
+
+    def call(self, url, send):
+        """Call `send()` for an idempotent request, hedging it when it runs long. Returns the first
+        successful response; the other one is closed when it arrives."""
+        host = urlparse(url).netloc
+        start = time.monotonic()
+        self._count_request(start)
+        delay = self.delay(host)
+        if delay is None:
+            # Nothing to hedge against yet, so just send it on the caller's thread
+            response = send()
+            self._record(host, time.monotonic() - start)
+            return response
+
+        # The first request gets its own thread rather than a pool slot, so it never waits in a queue
+        primary = Future()
+        threading.Thread(target=_run, args=(primary, send), daemon=True, name="skafos-hedge-primary").start()
+        futures = [primary]
+        done, _ = wait(futures, timeout=delay)
+        if not done and self._allow_hedge():
+            logger.debug("Hedging request to {} after {:.3f} seconds".format(host, delay))
+            futures.append(self._executor.submit(self._hedge, send))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._record(host, time.monotonic() - start)
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+
+def _run(future, send):
+    # Resolve a future with the outcome of send(), on a thread of its own
+    try:
+        future.set_result(send())
+    except BaseException as err:
+        future.set_exception(err)
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+hedger = None
+
+
+def configure(enabled=True, percentile=DEFAULT_PERCENTILE, min_delay=DEFAULT_MIN_DELAY,
+              max_extra_load=DEFAULT_MAX_EXTRA_LOAD):
+    r"""
+    Enable hedged requests for idempotent metadata calls, such as :func:`skafos.models.list_versions`,
+    :func:`skafos.models.list_environments`, and :func:`skafos.summary`. When a call takes longer than the given
+    percentile of recent calls to the same host, an identical second request is sent and whichever response
+    arrives first is used. Disabled by default.
+
+    :param enabled:
+        Turn hedging on (True) or off (False).
+    :type enabled:
+        boolean
+    :param percentile:
+        Percentile of recent latencies to wait for before hedging. Defaults to 95.
+    :type percentile:
+        int or float
+    :param min_delay:
+        Minimum number of seconds to wait before hedging. Defaults to 0.01.
+    :type min_delay:
+        float
+    :param max_extra_load:
+        Maximum share of requests that may be hedged. Defaults to 0.05 (5% extra load).
+    :type max_extra_load:
+        float
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import hedging
+
+       hedging.configure(percentile=99, max_extra_load=0.02)
+
+    """
+    global hedger
+    if hedger is not None:
+        hedger._executor.shutdown(wait=False)
+    hedger = Hedger(percentile=percentile, min_delay=min_delay, max_extra_load=max_extra_load) if enabled else None
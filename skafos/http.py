@@ -1,15 +1,23 @@
 import os
+import time
 import requests
 import logging
 import json
 
 from .exceptions import *
+from . import hedging, integrity, ratelimit
+from .transport import get_transport
 
 
 API_BASE_URL = "https://api.skafos.ai/v2"
 DOWNLOAD_BASE_URL = "https://download.skafos.ai/v2"
 HTTP_VERBS = ["GET", "POST", "PUT", "PATCH"]
-DEFAULT_TIMEOUT = 120
+# (connect, read) timeouts in seconds. Read timeouts bound the wait between bytes, not the whole transfer.
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_METADATA_TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, 30)
+DEFAULT_TRANSFER_TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, 300)
+# Times a request is retried after a 429 (Too Many Requests) response
+RATE_LIMIT_RETRIES = 3
 logger = logging.getLogger(name="skafos.http")
 
 
@@ -52,7 +60,78 @@ def _generate_required_params(args):
     return params
 
 
-def _http_request(method, url, api_token, header=None, timeout=None, payload=None, stream=False):
+class Deadline(object):
+    """Overall time budget shared by every request and retry of a composite operation."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        remaining = self.expires_at - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout("Operation deadline of {} seconds exceeded".format(self.seconds))
+        return remaining
+
+
+def _clamp_timeout(timeout, deadline):
+    # Never wait on a single request past the operation's deadline
+    if deadline is None:
+        return timeout
+    remaining = deadline.remaining()
+    if isinstance(timeout, tuple):
+        return tuple(min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+class _DeadlineReader(object):
+    # Request body that stops the upload once the operation's deadline passes, not just when a single read stalls
+    def __init__(self, fp, deadline):
+        self._fp = fp
+        self._deadline = deadline
+
+    def read(self, size=-1):
+        self._deadline.remaining()
+        return self._fp.read(size)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._fp.seek(offset, whence)
+
+
+def _request_kind(method, url, stream):
+    # Uploads and downloads are rate limited separately from metadata calls
+    if stream or method == "PUT" or url.startswith(DOWNLOAD_BASE_URL):
+        return ratelimit.TRANSFER
+    return ratelimit.METADATA
+
+
+def _send(transport, prepared, timeout, stream, kind, deadline):
+    # Send a prepared request through the shared rate limiter, backing off on 429s
+    body_position = prepared.body.tell() if hasattr(prepared.body, "tell") else None
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        if attempt and body_position is not None:
+            # Rewind streamed request bodies before sending them again
+            prepared.body.seek(body_position)
+        ratelimit.rate_limiter.acquire(prepared.url, kind, deadline)
+        try:
+            response = transport.send(prepared, timeout=_clamp_timeout(timeout, deadline), stream=stream)
+        except requests.exceptions.ConnectionError:
+            # An expired deadline cutting the request body short surfaces as a broken connection
+            if deadline is not None:
+                deadline.remaining()
+            raise
+        ratelimit.rate_limiter.record(prepared.url, kind, response.status_code, response.headers.get("Retry-After"))
+        if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return response
+        logger.debug("Got a 429 from the server, retrying request")
+        response.close()
+
+
+def _http_request(method, url, api_token, header=None, timeout=None, payload=None, stream=False, filename=None,
+                  deadline=None, kind=None):
     # Check that we ae using an appropriate request type
     if method not in HTTP_VERBS:
         raise requests.exceptions.HTTPError("Must use an appropriate HTTP verb")
@@ -62,26 +141,51 @@ def _http_request(method, url, api_token, header=None, timeout=None, payload=Non
     # Update request header with optionally provided header
     if header and isinstance(header, dict):
         request_header.update(header)
+    if kind is None:
+        kind = _request_kind(method, url, stream)
     if not timeout:
-        timeout = DEFAULT_TIMEOUT
+        timeout = DEFAULT_TRANSFER_TIMEOUT if kind == ratelimit.TRANSFER else DEFAULT_METADATA_TIMEOUT
+
+    if deadline is not None and hasattr(payload, "read"):
+        payload = _DeadlineReader(payload, deadline)
 
     # Prepare request object and send it
     try:
         req = requests.Request(method, url, headers=request_header, data=payload)
         r = req.prepare()
-        with requests.Session() as s:
-            logger.debug("Sending prepared request with url: {}".format(url))
-            if stream and method == "GET":
-                with s.send(r, timeout=timeout, stream=True) as response:
-                    response.raise_for_status()
-                    fn = url.split("models/")[1].split("?")[0]
-                    with open(fn + ".zip", 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=512*1024):
-                            if chunk:
-                                f.write(chunk)
-            else:
-                response = s.send(r, timeout=timeout)
+        transport = get_transport()
+        logger.debug("Sending prepared request with url: {}".format(url))
+        if stream and method == "GET":
+            with _send(transport, r, timeout=timeout, stream=True, kind=kind, deadline=deadline) as response:
                 response.raise_for_status()
+                if not filename:
+                    filename = url.split("models/")[1].split("?")[0] + ".zip"
+                # Check the download against any digests the server sends as the bytes stream through
+                expected = integrity.expected_digests(response.headers)
+                response.digests = integrity.Digests(("sha256",) + tuple(expected))
+                with open(filename, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=512*1024):
+                        if chunk:
+                            f.write(chunk)
+                            response.digests.update(chunk)
+                        if deadline is not None:
+                            deadline.remaining()
+                try:
+                    integrity.verify(response.digests, expected)
+                except DownloadFailedError:
+                    os.remove(filename)
+                    raise
+                logger.debug("Downloaded {} with sha256 {}".format(filename, response.digests.hexdigest("sha256")))
+        else:
+            hedger = hedging.hedger
+            if hedger is not None and method == "GET" and kind == ratelimit.METADATA:
+                # Idempotent metadata reads may be hedged, so each attempt sends its own copy of the request
+                response = hedger.call(url, lambda: _send(
+                    transport, r.copy(), timeout=timeout, stream=False, kind=kind, deadline=deadline
+                ))
+            else:
+                response = _send(transport, r, timeout=timeout, stream=False, kind=kind, deadline=deadline)
+            response.raise_for_status()
     except requests.exceptions.HTTPError as err:
         logger.debug("HTTP Error: {}".format(err))
         if response.status_code == 401:
@@ -0,0 +1,254 @@
+import os
+import json
+import sqlite3
+import datetime
+import threading
+
+from .exceptions import InvalidParamError
+
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".skafos", "index.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    org_name TEXT NOT NULL,
+    app_name TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (org_name, app_name, model_name)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    org_name TEXT NOT NULL,
+    app_name TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    name TEXT,
+    description TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (org_name, app_name, model_name, version)
+);
+CREATE TABLE IF NOT EXISTS environments (
+    org_name TEXT NOT NULL,
+    app_name TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    environment TEXT NOT NULL,
+    data TEXT,
+    PRIMARY KEY (org_name, app_name, model_name, environment)
+);
+CREATE INDEX IF NOT EXISTS models_updated_at ON models (updated_at);
+CREATE INDEX IF NOT EXISTS models_model_name ON models (model_name);
+CREATE INDEX IF NOT EXISTS versions_updated_at ON versions (updated_at);
+CREATE INDEX IF NOT EXISTS environments_environment ON environments (environment);
+"""
+
+
+def _check_timestamp(value, name):
+    # Timestamps are stored as ISO 8601 strings, so compare them that way
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise InvalidParamError("{} must be a datetime or an ISO 8601 string.".format(name))
+
+
+class MetadataIndex(object):
+    r"""
+    Local SQLite index of Skafos organizations, apps, models, model versions, and environments.
+
+    Pass an index to :func:`skafos.summary`, :func:`skafos.models.list_versions`, or
+    :func:`skafos.models.list_environments` and every record they fetch is upserted into it. The index
+    can then be queried without any network access.
+
+    :param path:
+        *Optional*. Location of the SQLite database. Checks environment for 'SKAFOS_INDEX_PATH' if not passed,
+        otherwise defaults to `~/.skafos/index.db`. Use ":memory:" for a throwaway in-memory index.
+    :type path:
+        str
+
+    :Usage:
+    .. sourcecode:: python
+
+       import skafos
+       from skafos.index import MetadataIndex
+
+       index = MetadataIndex()
+       skafos.summary(skafos_api_token="<YOUR-SKAFOS-API-TOKEN>", index=index)
+
+       # Models that changed since yesterday, across every organization
+       index.models(updated_since="2019-06-12T00:00:00")
+
+    """
+
+    def __init__(self, path=None):
+        if not path:
+            path = os.getenv("SKAFOS_INDEX_PATH", DEFAULT_INDEX_PATH)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, statement, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(statement, rows)
+
+    def _query(self, statement, args):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(statement, args)]
+
+    def add_apps(self, org_name, apps):
+        """Upsert the apps and models returned for an organization."""
+        rows = [
+            (org_name, app["name"], model["name"], model.get("updated_at"))
+            for app in apps for model in app.get("models", [])
+        ]
+        self._write(
+            "INSERT OR IGNORE INTO models (org_name, app_name, model_name, updated_at) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        self._write(
+            """UPDATE models SET updated_at = COALESCE(?, updated_at)
+            WHERE org_name = ? AND app_name = ? AND model_name = ?""",
+            [(updated_at, org, app, model) for org, app, model, updated_at in rows]
+        )
+
+    def add_versions(self, org_name, app_name, model_name, versions):
+        """Upsert model versions belonging to a model."""
+        rows = [
+            (org_name, app_name, model_name, v["version"], v.get("name"), v.get("description"), v.get("updated_at"))
+            for v in versions if v.get("version") is not None
+        ]
+        self._write(
+            """INSERT OR REPLACE INTO versions
+            (org_name, app_name, model_name, version, name, description, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            rows
+        )
+        self._write(
+            "INSERT OR IGNORE INTO models (org_name, app_name, model_name) VALUES (?, ?, ?)",
+            [(org_name, app_name, model_name)]
+        )
+
+    def add_environments(self, org_name, app_name, model_name, environments):
+        """Upsert the environments available to a model."""
+        rows = [
+            (org_name, app_name, model_name, env["name"], json.dumps(env, default=str))
+            for env in environments if env.get("name")
+        ]
+        self._write(
+            """INSERT OR REPLACE INTO environments (org_name, app_name, model_name, environment, data)
+            VALUES (?, ?, ?, ?, ?)""",
+            rows
+        )
+        self._write(
+            "INSERT OR IGNORE INTO models (org_name, app_name, model_name) VALUES (?, ?, ?)",
+            [(org_name, app_name, model_name)]
+        )
+
+    def models(self, org_name=None, app_name=None, model_name=None, updated_since=None, updated_before=None,
+               environment=None, version=None):
+        r"""
+        Query indexed models. All filters are optional and combined.
+
+        :param environment:
+            Only return models that have an environment with this name.
+        :param version:
+            Only return models that have this model version.
+        :return:
+            List of dictionaries with `org_name`, `app_name`, `model_name`, and `updated_at` keys.
+        """
+        clauses, args = self._model_clauses("m", org_name, app_name, model_name)
+        updated_since = _check_timestamp(updated_since, "updated_since")
+        updated_before = _check_timestamp(updated_before, "updated_before")
+        if updated_since:
+            clauses.append("m.updated_at >= ?")
+            args.append(updated_since)
+        if updated_before:
+            clauses.append("m.updated_at < ?")
+            args.append(updated_before)
+        if environment:
+            clauses.append("""EXISTS (SELECT 1 FROM environments e WHERE e.org_name = m.org_name
+                AND e.app_name = m.app_name AND e.model_name = m.model_name AND lower(e.environment) = lower(?))""")
+            args.append(environment)
+        if version is not None:
+            clauses.append("""EXISTS (SELECT 1 FROM versions v WHERE v.org_name = m.org_name
+                AND v.app_name = m.app_name AND v.model_name = m.model_name AND v.version = ?)""")
+            args.append(version)
+        statement = "SELECT m.org_name, m.app_name, m.model_name, m.updated_at FROM models m"
+        return self._query(self._where(statement, clauses) + " ORDER BY m.org_name, m.app_name, m.model_name", args)
+
+    def versions(self, org_name=None, app_name=None, model_name=None, version=None, updated_since=None,
+                 updated_before=None):
+        r"""
+        Query indexed model versions. All filters are optional and combined.
+
+        :return:
+            List of dictionaries with `org_name`, `app_name`, `model_name`, `version`, `name`, `description`,
+            and `updated_at` keys, ordered by version.
+        """
+        clauses, args = self._model_clauses("v", org_name, app_name, model_name)
+        updated_since = _check_timestamp(updated_since, "updated_since")
+        updated_before = _check_timestamp(updated_before, "updated_before")
+        if version is not None:
+            clauses.append("v.version = ?")
+            args.append(version)
+        if updated_since:
+            clauses.append("v.updated_at >= ?")
+            args.append(updated_since)
+        if updated_before:
+            clauses.append("v.updated_at < ?")
+            args.append(updated_before)
+        statement = "SELECT * FROM versions v"
+        return self._query(
+            self._where(statement, clauses) + " ORDER BY v.org_name, v.app_name, v.model_name, v.version", args
+        )
+
+    def environments(self, org_name=None, app_name=None, model_name=None, environment=None):
+        r"""
+        Query indexed environments. All filters are optional and combined.
+
+        :return:
+            List of environment dictionaries, as returned by :func:`skafos.models.list_environments`, with
+            `org_name`, `app_name`, and `model_name` keys added.
+        """
+        clauses, args = self._model_clauses("e", org_name, app_name, model_name)
+        if environment:
+            clauses.append("lower(e.environment) = lower(?)")
+            args.append(environment)
+        statement = "SELECT * FROM environments e"
+        rows = self._query(self._where(statement, clauses) + " ORDER BY e.org_name, e.app_name, e.model_name", args)
+        environments = []
+        for row in rows:
+            env = json.loads(row["data"])
+            env.update({k: row[k] for k in ("org_name", "app_name", "model_name")})
+            environments.append(env)
+        return environments
+
+    @staticmethod
+    def _model_clauses(alias, org_name, app_name, model_name):
+        clauses, args = [], []
+        for column, value in (("org_name", org_name), ("app_name", app_name), ("model_name", model_name)):
+            if value:
+                clauses.append("{}.{} = ?".format(alias, column))
+                args.append(value)
+        return clauses, args
+
+    @staticmethod
+    def _where(statement, clauses):
+        if clauses:
+            return statement + " WHERE " + " AND ".join(clauses)
+        return statement
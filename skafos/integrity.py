@@ -0,0 +1,170 @@
+import os
+import base64
+import struct
+import hashlib
+import logging
+
+from .exceptions import DownloadFailedError
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # Optional, only needed to check CRC32C digests
+    _crc32c = None
+
+
+logger = logging.getLogger(name="skafos.integrity")
+
+# Whether uploads send a Content-MD5 header for storage to check
+content_md5 = os.getenv("SKAFOS_UPLOAD_CONTENT_MD5", "").lower() in ("1", "true", "yes")
+
+
+def configure(upload_content_md5=False):
+    r"""
+    Configure upload integrity checks. Can also be enabled from the environment with `SKAFOS_UPLOAD_CONTENT_MD5=1`.
+
+    .. note:: Only enable `upload_content_md5` when the presigned upload URLs Skafos hands out accept a
+       `Content-MD5` header. Signing schemes that include it in the string to sign (S3 signature version 2,
+       GCS V2 signed URLs) reject uploads carrying a header they weren't signed with.
+
+    :param upload_content_md5:
+        If True, send a `Content-MD5` header with archives the SDK builds, so storage rejects anything that
+        arrives altered. False by default.
+    :type upload_content_md5:
+        bool
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import integrity
+
+       integrity.configure(upload_content_md5=True)
+
+    """
+    global content_md5
+    content_md5 = upload_content_md5
+
+
+class _CRC32C(object):
+    # hashlib-style wrapper around the optional crc32c package
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = _crc32c.crc32c(data, self._value)
+
+    def digest(self):
+        return struct.pack(">I", self._value)
+
+
+def _new_hash(name):
+    if name == "crc32c":
+        return _CRC32C() if _crc32c else None
+    return hashlib.new(name)
+
+
+class Digests(object):
+    """Digests of a byte stream, updated incrementally as the bytes go by."""
+
+    def __init__(self, algorithms=("sha256",)):
+        self._hashes = {}
+        for name in algorithms:
+            if name not in self._hashes:
+                new_hash = _new_hash(name)
+                if new_hash is None:
+                    logger.debug("Skipping {} digest, install the crc32c package to compute it".format(name))
+                    continue
+                self._hashes[name] = new_hash
+        self._digests = None
+
+    def __contains__(self, name):
+        return name in self._hashes or (self._digests is not None and name in self._digests)
+
+    def update(self, data):
+        for new_hash in self._hashes.values():
+            new_hash.update(data)
+
+    def digest(self, name):
+        if self._digests is not None:
+            return self._digests[name]
+        return self._hashes[name].digest()
+
+    def hexdigest(self, name):
+        return self.digest(name).hex()
+
+    def b64digest(self, name):
+        return base64.b64encode(self.digest(name)).decode("ascii")
+
+    def to_dict(self):
+        names = self._digests if self._digests is not None else self._hashes
+        return {name: self.hexdigest(name) for name in names}
+
+    @classmethod
+    def from_dict(cls, values):
+        # Digests computed earlier, for example stored next to a cached archive
+        digests = cls(algorithms=())
+        digests._digests = {name: bytes.fromhex(value) for name, value in values.items()}
+        return digests
+
+
+class HashingWriter(object):
+    """Write-only file wrapper that updates digests with every write. It can't seek, so a ZipFile
+    writing to it streams its members out in a single pass."""
+
+    def __init__(self, fp, digests):
+        self._fp = fp
+        self.digests = digests
+        self._position = 0
+
+    def write(self, data):
+        self._fp.write(data)
+        self.digests.update(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        self._fp.flush()
+
+
+def file_digests(path, algorithms):
+    """Digest a file that wasn't hashed when it was written."""
+    digests = Digests(algorithms)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            digests.update(chunk)
+    return digests
+
+
+def _b64decode(value):
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except (ValueError, TypeError):
+        return None
+
+
+_DIGEST_NAMES = {"sha-256": "sha256", "sha256": "sha256", "md5": "md5", "crc32c": "crc32c"}
+
+
+def expected_digests(headers):
+    """Collect the digests a download response advertises, from the headers storage services use."""
+    expected = {}
+    for header in ("Digest", "x-goog-hash"):
+        for part in headers.get(header, "").split(","):
+            name, _, value = part.strip().partition("=")
+            name = _DIGEST_NAMES.get(name.lower())
+            if name and _b64decode(value):
+                expected[name] = _b64decode(value)
+    for header, name in (("x-amz-checksum-sha256", "sha256"), ("x-amz-checksum-crc32c", "crc32c"),
+                         ("Content-MD5", "md5")):
+        if headers.get(header) and _b64decode(headers[header]):
+            expected[name] = _b64decode(headers[header])
+    return expected
+
+
+def verify(digests, expected):
+    """Raise DownloadFailedError if any digest we could compute doesn't match the expected one."""
+    for name, value in expected.items():
+        if name in digests and digests.digest(name) != value:
+            raise DownloadFailedError("Model version download failed integrity check ({} mismatch).".format(name))
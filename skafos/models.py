@@ -1,39 +1,121 @@
+import io
 import os
+import glob
 import json
 import zipfile
-import tempfile
 import shutil
+import logging
+import datetime
+from urllib.parse import urlencode
+from collections.abc import Mapping
+from functools import partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 from .http import *
-from .http import _generate_required_params, _http_request
+from .http import _generate_required_params, _http_request, Deadline
 from .exceptions import *
+from . import archive, delta, integrity, peercache, scratch
+from .archive import ARCHIVE_DIGESTS
+from .singleflight import SingleFlight
+from .filelock import FileLock
 
 
-def _validate_files(files):
-    for file in files:
-        if os.path.exists(file):
-            if file.endswith(".zip"):
-                if zipfile.is_zipfile(file):
-                    continue
-                else:
-                    raise InvalidParamError("{} is an invalid zipfile. Can't upload to Skafos.".format(file))
-        else:
-            InvalidParamError("{} file doesn't exist. Can't upload to Skafos.".format(file))
+DEFAULT_PAGE_SIZE = 100
+# Fail over to Skafos quickly when the peer cache is unreachable
+PEER_CACHE_TIMEOUT = (1, 60)
+logger = logging.getLogger(name="skafos.models")
+# Identical fetches and listings running at the same time are coalesced into one request
+_inflight = SingleFlight()
 
 
 def _create_filelist(files):
-    # Create file list and perform validation
+    # Create file list; the files themselves are validated when they are scanned
     if isinstance(files, str):
         files = [files]
     elif isinstance(files, list):
         pass
     else:
-        raise InvalidParamError("Files must be either a list or a string.")
-    # Return validated filelist back to the user
-    _validate_files(files)
+        raise InvalidParamError("Files must be a list, a string, an in-memory buffer, or a mapping of names to buffers.")
     return files
 
 
+def _is_buffer(obj):
+    # In-memory model data: raw bytes or a readable file object
+    return isinstance(obj, (bytes, bytearray, memoryview)) or hasattr(obj, "read")
+
+
+def _check_buffers(files):
+    # Validate in-memory inputs up front, so a bad one never creates a model version record
+    if isinstance(files, Mapping):
+        for name, buffer in files.items():
+            if not isinstance(name, str) or not _is_buffer(buffer):
+                raise InvalidParamError("In-memory files must map archive names to bytes or file objects.")
+
+
+def _buffer_name(buffer, model_filename):
+    # Name an in-memory buffer inside the archive after its file object or, failing that, the model
+    name = getattr(buffer, "name", None)
+    if isinstance(name, str) and name:
+        return os.path.basename(name)
+    return model_filename[:-len(".zip")]
+
+
+def _is_zip_buffer(buffer):
+    # Check an in-memory buffer for a zip archive without moving its read position
+    if not hasattr(buffer, "read"):
+        return zipfile.is_zipfile(io.BytesIO(buffer))
+    try:
+        position = buffer.tell()
+        is_zip = zipfile.is_zipfile(buffer)
+        buffer.seek(position)
+        return is_zip
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+
+def _buffer_payload(buffer):
+    # Requests can stream bytes and file objects as a request body
+    if isinstance(buffer, (bytearray, memoryview)):
+        return bytes(buffer)
+    return buffer
+
+
+def _named_buffers(files, model_filename):
+    # In-memory inputs as a mapping of archive names to buffers
+    if isinstance(files, Mapping):
+        return files
+    return {_buffer_name(files, model_filename): files}
+
+
+def _zip_buffer(buffers, model_filename):
+    # A single zip archive named after the model is uploaded as is; returns it, or None
+    if list(buffers) == [model_filename] and _is_zip_buffer(buffers[model_filename]):
+        return buffers[model_filename]
+    return None
+
+
+def _zip_buffers(model_filename, buffers):
+    # Zip in-memory buffers into an in-memory archive, never touching the filesystem. Returns the
+    # archive and its digests, hashed as it is written.
+    buffers = _named_buffers(buffers, model_filename)
+    zip_buffer = _zip_buffer(buffers, model_filename)
+    if zip_buffer is not None:
+        payload = _buffer_payload(zip_buffer)
+        return payload, None if hasattr(payload, "read") else _bytes_digests(payload)
+    archive = io.BytesIO()
+    writer = integrity.HashingWriter(archive, integrity.Digests(ARCHIVE_DIGESTS))
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as skazip:
+        for name, buffer in buffers.items():
+            if hasattr(buffer, "read"):
+                with skazip.open(name, "w") as member:
+                    shutil.copyfileobj(buffer, member, 1024*1024)
+            else:
+                skazip.writestr(name, memoryview(buffer).cast("B"))
+    archive.seek(0)
+    return archive, writer.digests
+
+
 def _create_filename(model_name):
     # Create the name of the zipfile based on the provided model name
     if model_name.endswith(".zip"):
@@ -57,23 +139,117 @@ def _check_description(desc):
         return None
 
 
-def _zip_archive(name, filelist):
-    # Create a temp directory
-    tmp_dir_path = tempfile.mkdtemp()
-    model_path = tmp_dir_path + "/" + name
-    # Create a zip archive
-    with zipfile.ZipFile(model_path, "w", zipfile.ZIP_DEFLATED) as skazip:
-        for zfile in filelist:
-            if os.path.isdir(zfile):
-                for root, dirs, files in os.walk(zfile):
-                    for dfile in files:
-                        skazip.write(os.path.join(root, dfile))
-            elif os.path.isfile(zfile):
-                skazip.write(zfile)
+def _zip_archive(name, manifest, directory):
+    # Create the zip archive inside the given scratch directory
+    return archive.write_archive(os.path.join(directory, name), manifest)
+
+
+def _bytes_digests(data):
+    # Digest upload data that is already in memory
+    digests = integrity.Digests(ARCHIVE_DIGESTS)
+    digests.update(data)
+    return digests
+
+
+def _is_lone_zip(filelist, model_filename):
+    # A single zip named like the upload is sent as it is
+    return len(filelist) == 1 and model_filename == filelist[0]
+
+
+def _needs_scratch(filelist, model_filename):
+    # Archives built from files on disk go through scratch space, unless delta uploads or the archive cache take them
+    return (filelist is not None and not _is_lone_zip(filelist, model_filename)
+            and delta.chunk_store is None and archive.archive_cache is None)
+
+
+def _check_record(record):
+    # Raise as soon as creating the model version record has failed
+    if record.done() and record.exception() is not None:
+        raise record.exception()
+
+
+def _until_record_fails(items, record):
+    # Stop packaging between files once the model version record has failed, rather than finishing the archive
+    for item in items:
+        _check_record(record)
+        yield item
+
+
+def _pack_delta(members, store, api_token, record, verbose):
+    # Only chunks the chunk store is missing are uploaded; the model version itself is the delta manifest
+    model_data = delta.pack(_until_record_fails(members, record), store, api_token)
+    if verbose:
+        print("Uploaded new chunks to the chunk store.", flush=True)
+    return None, model_data, _bytes_digests(model_data)
+
+
+def _package_upload(files, filelist, manifest, model_filename, api_token, tmp_dir, record, verbose):
+    # Zip in-memory buffers in memory, otherwise create the zip archive in the reserved scratch directory.
+    # Returns the archive path, or the archive data itself when it never touched disk, and the
+    # archive's digests.
+    store = delta.chunk_store
+    if filelist is None:
+        if store is not None:
+            buffers = _named_buffers(files, model_filename)
+            zip_buffer = _zip_buffer(buffers, model_filename)
+            if zip_buffer is not None:
+                members = delta.zip_members(zip_buffer if hasattr(zip_buffer, "read") else io.BytesIO(zip_buffer))
             else:
-                raise InvalidParamError("""We were unable to find {}. Check to
-                make sure that the file path is correct.""".format(zfile))
-    return model_path
+                members = delta.buffer_members(buffers)
+            return _pack_delta(members, store, api_token, record, verbose)
+        model_data, digests = _zip_buffers(model_filename=model_filename, buffers=files)
+        if verbose:
+            print("Zipped in-memory archive to upload to Skafos.", flush=True)
+        return None, model_data, digests
+    lone_zip = _is_lone_zip(filelist, model_filename)
+    if store is not None:
+        if lone_zip:
+            members = delta.zip_members(model_filename)
+        else:
+            members = delta.file_members(manifest)
+        return _pack_delta(members, store, api_token, record, verbose)
+    if lone_zip:
+        # Hashed while it uploads rather than read an extra time up front
+        return model_filename, None, None
+    cache = archive.archive_cache
+    if cache is not None:
+        if cache.hash_files:
+            manifest = archive.hash_manifest(manifest)
+        _check_record(record)
+        # Reuse a cached archive of the same files, or splice in unchanged members
+        model_path, digests = cache.archive(manifest)
+        if verbose:
+            print("Zipped archive to upload to Skafos from the archive cache.", flush=True)
+        return model_path, None, digests
+    model_path, digests = _zip_archive(
+        name=model_filename, manifest=_until_record_fails(manifest, record), directory=tmp_dir
+    )
+    if verbose:
+        print("Created temp dir and zipped archive to upload to Skafos.", flush=True)
+    return model_path, None, digests
+
+
+def _create_model_version(endpoint, body, api_token, deadline=None):
+    # Create a model version record and get a presigned URL to upload to
+    return _http_request(
+        method="POST",
+        url=API_BASE_URL + endpoint + "model_versions",
+        payload=json.dumps(body),
+        api_token=api_token,
+        deadline=deadline
+    ).json()
+
+
+def _abandon_model_version(record):
+    # Packaging failed, so the record is never uploaded to or updated with a filepath.
+    # Records without a filepath are incomplete uploads on Skafos and are never served.
+    if record.cancel():
+        return
+    try:
+        model_version_res = record.result()
+        logger.debug("Abandoned model version record {}".format(model_version_res.get("model_version_id")))
+    except Exception as err:
+        logger.debug("Creating model version record failed while packaging failed: {}".format(err))
 
 
 def _model_version_meta_data(res):
@@ -81,7 +257,7 @@ def _model_version_meta_data(res):
     return {k: res[k] for k in res.keys() & {"version", "description", "name", "model"}}
 
 
-def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
+def upload_version(files, description=None, verbose=True, deadline=None, **kwargs) -> dict:
     r"""
     Upload a model version, belonging to a specific app and model, to Skafos. All files
     are automatically zipped together and uploaded to storage. Once successfully uploaded, a dictionary
@@ -91,9 +267,11 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
               path pointing to the file(s). We recommend placing your file(s) in your current working directory before upload.
 
     :param files:
-        Single model file path or list of file paths to zip up and upload to Skafos.
+        Single model file path or list of file paths to zip up and upload to Skafos. In-memory model data can be
+        passed directly as bytes, a memoryview, a file object, or a mapping of archive names to any of those;
+        it is zipped in memory and never written to disk.
     :type files:
-        str or list
+        str, list, bytes, memoryview, file object, or dict
     :param description:
         *Optional*. Short description for your model version. Must be less than or equal to 255 characters.
     :type description:
@@ -102,6 +280,11 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
         Control the amount of console print statements you see when working with the SDK. True by default.
     :type verbose:
         boolean
+    :param deadline:
+        *Optional*. Overall time limit in seconds for the upload, covering creating the model version record,
+        uploading to storage, updating the record, and any retries. No limit by default.
+    :type deadline:
+        int or float
     :param \**kwargs:
         Keyword arguments identifying the organization, app, and model for upload. See below.
     :return:
@@ -140,9 +323,8 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
     """
     # Generate required connection params
     params = _generate_required_params(kwargs)
-
-    # Generate and validate file list
-    filelist = _create_filelist(files)
+    if deadline:
+        deadline = Deadline(deadline)
 
     # Create zipped model filename
     model_filename = _create_filename(model_name=params["model_name"])
@@ -153,49 +335,73 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
     if description:
         body["description"] = description
 
-    # Create the zip archive in a tmp dir by default
-    create_temp_dir = False
-    if (len(filelist) == 1) and (model_filename == filelist[0]):
-        model_path = model_filename
+    # Generate the file list and scan it into a validated manifest before anything is created on Skafos
+    if _is_buffer(files) or isinstance(files, Mapping):
+        _check_buffers(files)
+        filelist = None
     else:
-        create_temp_dir = True
-        model_path = _zip_archive(name=model_filename, filelist=filelist)
-        if verbose:
-            print("Created temp dir and zipped archive to upload to Skafos.", flush=True)
+        filelist = _create_filelist(files)
+    manifest = None if filelist is None else archive.scan(filelist)
 
-    # Create a model version record
     endpoint = "/organizations/{org_name}/apps/{app_name}/models/{model_name}/".format(**params)
-    model_version_res = _http_request(
-        method="POST",
-        url=API_BASE_URL + endpoint + "model_versions",
-        payload=json.dumps(body),
-        api_token=params["skafos_api_token"]
-    ).json()
-    if verbose:
-        print("Created model version record on Skafos.", flush=True)
-
-    # Upload the model to storage
-    if model_version_res.get("presigned_url"):
-        with open(model_path, "rb") as data:
-            model_data = data.read()
-        if verbose:
-            print("Started uploading model version to Skafos.", flush=True)
-        upload_res = _http_request(
-            method="PUT",
-            url=model_version_res["presigned_url"],
-            header={"Content-Type": "application/octet-stream"},
-            payload=model_data,
-            api_token=params["skafos_api_token"]
+    with ExitStack() as cleanup, ThreadPoolExecutor(max_workers=1) as executor:
+        # Wait out scratch quota back-pressure before the record exists, so its presigned URL isn't left idle.
+        # The scratch directory is removed once the cleanup stack unwinds, even if the upload fails.
+        tmp_dir = None
+        if _needs_scratch(filelist, model_filename):
+            size = sum(entry.size for entry in manifest)
+            tmp_dir = cleanup.enter_context(scratch.scratch_space.workspace(size=size, deadline=deadline))
+        # Creating the record only needs the filename and description, so do it while packaging
+        record = executor.submit(
+            _create_model_version,
+            endpoint=endpoint,
+            body=body,
+            api_token=params["skafos_api_token"],
+            deadline=deadline
         )
+        try:
+            model_path, model_data, digests = _package_upload(
+                files=files,
+                filelist=filelist,
+                manifest=manifest,
+                model_filename=model_filename,
+                api_token=params["skafos_api_token"],
+                tmp_dir=tmp_dir,
+                record=record,
+                verbose=verbose
+            )
+        except BaseException:
+            _abandon_model_version(record)
+            raise
+        model_version_res = record.result()
         if verbose:
-            print("Finished uploading model version to Skafos.", flush=True)
-        # Remove temporary directory
-        if create_temp_dir:
+            print("Created model version record on Skafos.", flush=True)
+
+        # Upload the model to storage
+        if model_version_res.get("presigned_url"):
+            if model_data is None:
+                # Stream the archive from disk rather than reading it into memory
+                model_data = cleanup.enter_context(open(model_path, "rb"))
+            header = {"Content-Type": "application/octet-stream"}
+            if digests is not None:
+                if integrity.content_md5:
+                    # Storage rejects the upload if the bytes it receives don't match
+                    header["Content-MD5"] = digests.b64digest("md5")
+                logger.debug("Uploading archive with sha256 {}".format(digests.hexdigest("sha256")))
             if verbose:
-                print("Removing tmp directory {}".format(model_path))
-            shutil.rmtree(model_path, ignore_errors=True)
-    else:
-        raise UploadFailedError("Model upload failed.")
+                print("Started uploading model version to Skafos.", flush=True)
+            upload_res = _http_request(
+                method="PUT",
+                url=model_version_res["presigned_url"],
+                header=header,
+                payload=model_data,
+                api_token=params["skafos_api_token"],
+                deadline=deadline
+            )
+            if verbose:
+                print("Finished uploading model version to Skafos.", flush=True)
+        else:
+            raise UploadFailedError("Model upload failed.")
 
     # Update the model version with the file path in storage
     if upload_res.status_code == 200:
@@ -205,7 +411,8 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
             method="PATCH",
             url=API_BASE_URL + model_version_endpoint,
             payload=json.dumps(data),
-            api_token=params["skafos_api_token"]
+            api_token=params["skafos_api_token"],
+            deadline=deadline
         ).json()
         if verbose:
             print("Updated model version record.", flush=True)
@@ -218,19 +425,30 @@ def upload_version(files, description=None, verbose=True, **kwargs) -> dict:
     return meta
 
 
-def fetch_version(version=None, **kwargs):
+def fetch_version(version=None, cache_dir=None, **kwargs):
     r"""
     Download a model version, belonging to a specific app and model, as a zipped archive to your current
     working directory as `<model_name>.zip`.
 
+    .. note:: When many processes on a host fetch the same model version (for example web server workers at startup),
+              give them a shared `cache_dir`. Exactly one process downloads each version while the others wait and
+              then reuse the downloaded archive.
+
     :param version:
         Version of the model to download. If unspecified, defaults to the latest version.
     :type version:
         int
+    :param cache_dir:
+        *Optional*. Shared download cache directory. Checks environment for 'SKAFOS_DOWNLOAD_CACHE_DIR' if not passed.
+        When set, the model version is downloaded into the cache (once per host) instead of your working directory,
+        and the path of the cached archive is returned.
+    :type cache_dir:
+        str
     :param \**kwargs:
         Keyword arguments identifying the organization, app, and model for download. See below.
     :return:
-        None
+        Path to the downloaded zip archive. Concurrent calls for the same model version share one download
+        and all return the same path.
 
     :Keyword Args:
         * *skafos_api_token* (``str``) --
@@ -275,9 +493,6 @@ def fetch_version(version=None, **kwargs):
 
     # Create filename for the model when it gets downloaded
     model_filename = _create_filename(model_name=params["model_name"])
-    if os.path.exists(model_filename):
-        raise InvalidParamError("""You are trying to download a file ({}) that will overwrite an existing file
-        in your current working directory. Rename or move the file and try again.""".format(model_filename))
 
     # Get model version and create endpoint
     endpoint = "/organizations/{org_name}/apps/{app_name}/models/{model_name}".format(**params)
@@ -287,19 +502,104 @@ def fetch_version(version=None, **kwargs):
         else:  # You passed in a non-supported version
             raise InvalidParamError("If specified, the model version must be an integer.")
 
-    # Download the model
-    print("Fetching model version.", flush=True)
-    method = "GET"
-    res = _http_request(
-        method=method,
+    # Download through the shared cache, coordinating with other processes on this host
+    if not cache_dir:
+        cache_dir = os.getenv("SKAFOS_DOWNLOAD_CACHE_DIR")
+    if cache_dir:
+        if not version:
+            version = _latest_version(params)
+            endpoint += "?version={}".format(version)
+        cache_path = os.path.join(cache_dir, params["org_name"], params["app_name"], params["model_name"],
+                                  "{}.zip".format(version))
+        key = ("fetch_version", params["skafos_api_token"], endpoint, cache_path)
+        return _inflight.do(key, _download_cached_version, params=params, endpoint=endpoint, cache_path=cache_path)
+
+    # Concurrent fetches of the same version to the same file share a single download
+    key = ("fetch_version", params["skafos_api_token"], endpoint, os.path.abspath(model_filename))
+    return _inflight.do(key, _download_version, params=params, endpoint=endpoint, model_filename=model_filename)
+
+
+def _download_model(endpoint, api_token, filename):
+    res = _download_archive(endpoint, api_token, filename)
+    if delta.is_manifest(filename):
+        # Uploaded as a delta, so put the archive back together from the chunk store
+        if delta.chunk_store is None:
+            os.remove(filename)
+            raise DownloadFailedError("Model version was uploaded as a delta. Configure skafos.delta with its chunk store to download it.")
+        delta.expand(filename, delta.chunk_store, api_token)
+    return res
+
+
+def _download_archive(endpoint, api_token, filename):
+    # Prefer a peer cache on the local network when one is configured, falling back to Skafos
+    peer_cache_url = peercache.peer_cache_url
+    if peer_cache_url:
+        try:
+            return _http_request(
+                method="GET",
+                url=peer_cache_url.rstrip("/") + endpoint,
+                api_token=api_token,
+                timeout=PEER_CACHE_TIMEOUT,
+                stream=True,
+                filename=filename
+            )
+        except Exception as err:
+            logger.debug("Peer cache download failed, falling back to Skafos: {}".format(err))
+    return _http_request(
+        method="GET",
         url=DOWNLOAD_BASE_URL + endpoint,
-        api_token=params["skafos_api_token"],
-        stream=True
+        api_token=api_token,
+        stream=True,
+        filename=filename
     )
 
+
+def _latest_version(params):
+    # Cached archives are keyed by version, so pin "latest" to an actual version number
+    latest = next(iter_versions(descending=True, limit=1, **params), None)
+    if latest is None:
+        raise DownloadFailedError("Model version download failed. Check parameters and that a version actually exists for this model.")
+    return latest["version"]
+
+
+def _download_cached_version(params, endpoint, cache_path):
+    if os.path.exists(cache_path):
+        return cache_path
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Only one process downloads; the rest wait on the lock and find the finished archive
+    with FileLock(cache_path + ".lock"):
+        if os.path.exists(cache_path):
+            return cache_path
+        # Nobody else downloads while we hold the lock, so any partial download left is from a crashed process
+        for stale_path in glob.glob(glob.escape(cache_path) + ".*.tmp"):
+            logger.debug("Removing stale partial download {}".format(stale_path))
+            os.remove(stale_path)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        try:
+            print("Fetching model version.", flush=True)
+            _download_model(endpoint=endpoint, api_token=params["skafos_api_token"], filename=tmp_path)
+            # Readers only ever see a complete archive
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    print("Downloaded model file as {}.".format(cache_path), flush=True)
+    return cache_path
+
+
+def _download_version(params, endpoint, model_filename):
+    if os.path.exists(model_filename):
+        raise InvalidParamError("""You are trying to download a file ({}) that will overwrite an existing file
+        in your current working directory. Rename or move the file and try again.""".format(model_filename))
+
+    # Download the model
+    print("Fetching model version.", flush=True)
+    res = _download_model(endpoint=endpoint, api_token=params["skafos_api_token"], filename=model_filename)
+
     # Log success message
     if res.status_code == 200:
         print("Downloaded model file as {}.".format(model_filename), flush=True)
+    return model_filename
 
 
 # Clean up the response so users have something manageable
@@ -311,10 +611,194 @@ def _clean_up_version_list(res):
     return versions
 
 
-def list_versions(**kwargs) -> list:
+def _check_version_filters(limit, since_version, since_updated_at, page_size):
+    # Check the optional filters used when listing model versions
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        raise InvalidParamError("If specified, limit must be a non-negative integer.")
+    if since_version is not None and not isinstance(since_version, int):
+        raise InvalidParamError("If specified, since_version must be an integer.")
+    if isinstance(since_updated_at, datetime.datetime):
+        since_updated_at = since_updated_at.isoformat()
+    elif since_updated_at is not None and not isinstance(since_updated_at, str):
+        raise InvalidParamError("If specified, since_updated_at must be a datetime or an ISO 8601 string.")
+    if not isinstance(page_size, int) or page_size < 1:
+        raise InvalidParamError("Page size must be a positive integer.")
+    return since_updated_at
+
+
+def _version_list_endpoint(params, page, page_size, descending, since_version, since_updated_at):
+    # Build the model versions endpoint for a single page of results
+    query = [("order_by", "version"), ("page", page), ("per_page", page_size)]
+    if descending:
+        query.append(("order", "desc"))
+    if since_version is not None:
+        query.append(("since_version", since_version))
+    if since_updated_at:
+        query.append(("updated_since", since_updated_at))
+    endpoint = "/organizations/{org_name}/apps/{app_name}/models/{model_name}/model_versions".format(**params)
+    return endpoint + "?" + urlencode(query)
+
+
+def _version_page(params, page, page_size, descending, since_version, since_updated_at):
+    endpoint = _version_list_endpoint(params, page, page_size, descending, since_version, since_updated_at)
+    return _http_request(
+        method="GET",
+        url=API_BASE_URL + endpoint,
+        api_token=params["skafos_api_token"]
+    ).json()
+
+
+def _in_order(res, descending, previous):
+    # Check a page follows the requested order, including across the boundary with the previous page
+    keys = ([previous] if previous is not None else []) + [v.get("version", 0) for v in res]
+    return keys == sorted(keys, reverse=descending)
+
+
+def _paginate_versions(params, limit, since_version, since_updated_at, descending, page_size, index):
+    # Lazily walk the model version pages, applying filters as records arrive
+    yielded = 0
+    seen = set()
+    page = 1
+    previous = None
+    fetch = partial(_version_page, params, page_size=page_size, descending=descending, since_version=since_version,
+                    since_updated_at=since_updated_at)
+    while limit is None or yielded < limit:
+        res = fetch(page)
+        last_page = len(res) != page_size
+        if len(res) > page_size or not _in_order(res, descending, previous):
+            # Server ignores pagination or ordering (older deployments), so collect every remaining
+            # version and order them ourselves
+            while not last_page:
+                page += 1
+                more = fetch(page)
+                known = {v.get("version") for v in res}
+                res.extend(more)
+                last_page = len(more) != page_size or all(v.get("version") in known for v in more)
+            res = sorted(res, key=lambda v: v.get("version", 0), reverse=descending)
+            last_page = True
+        versions = _clean_up_version_list(res)
+        if index is not None:
+            index.add_versions(params["org_name"], params["app_name"], params["model_name"], versions)
+        new_records = 0
+        for model_version in versions:
+            if model_version.get("version") in seen:
+                continue
+            seen.add(model_version.get("version"))
+            new_records += 1
+            # Filters are applied server-side too, this guards against older API deployments
+            if since_version is not None and model_version.get("version", 0) <= since_version:
+                continue
+            if since_updated_at and (model_version.get("updated_at") or "") <= since_updated_at:
+                continue
+            yield model_version
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+        if new_records == 0 or last_page:
+            return
+        previous = res[-1].get("version", 0) if res else None
+        page += 1
+
+
+def iter_versions(limit=None, since_version=None, since_updated_at=None, descending=False,
+                  page_size=DEFAULT_PAGE_SIZE, index=None, **kwargs):
+    r"""
+    Lazily iterate over saved model versions belonging to an organization, app, and model. Versions are
+    fetched from Skafos one page at a time, so you can stop iterating early without pulling the entire version history.
+
+    :param limit:
+        *Optional*. Maximum number of model versions to return.
+    :type limit:
+        int
+    :param since_version:
+        *Optional*. Only return model versions newer than this version.
+    :type since_version:
+        int
+    :param since_updated_at:
+        *Optional*. Only return model versions updated after this time.
+    :type since_updated_at:
+        datetime or str (ISO 8601)
+    :param descending:
+        If True, return the newest model versions first. False by default.
+    :type descending:
+        boolean
+    :param page_size:
+        Number of model versions requested from Skafos per page. Defaults to 100.
+    :type page_size:
+        int
+    :param index:
+        *Optional*. Local metadata index to record every fetched model version in.
+    :type index:
+        skafos.index.MetadataIndex
+    :param \**kwargs:
+        Keyword arguments identifying the organization, app, and model for version retrieval. See below.
+    :return:
+        Generator of dictionaries containing model versions that have been successfully uploaded to Skafos.
+
+    :Keyword Args:
+        * *skafos_api_token* (``str``) --
+            If not provided, it will be read from the environment as `SKAFOS_API_TOKEN`.
+        * *org_name* (``str``) --
+            If not provided, it will be read from the environment as `SKAFOS_ORG_NAME`.
+        * *app_name* (``str``) --
+            If not provided, it will be read from the environment as `SKAFOS_APP_NAME`.
+        * *model_name* (``str``) --
+            If not provided, it will be read from the environment as `SKAFOS_MODEL_NAME`.
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import models
+
+       # Get the five most recent model versions
+       for version in models.iter_versions(
+           skafos_api_token="<your-api-token>",
+           org_name="<your-organization>",
+           app_name="<your-app>",
+           model_name="<your-model>",
+           descending=True,
+           limit=5
+       ):
+           print(version)
+
+    :raises:
+        * `InvalidTokenError` - if improper API token is used or is missing entirely.
+        * `InvalidParamError` - if improper connection parameters or filters are passed.
+
+    """
+    # Validate everything up front so errors raise before iteration starts
+    params = _generate_required_params(kwargs)
+    since_updated_at = _check_version_filters(limit, since_version, since_updated_at, page_size)
+    return _paginate_versions(params, limit, since_version, since_updated_at, descending, page_size, index)
+
+
+def list_versions(limit=None, since_version=None, since_updated_at=None, descending=False, index=None,
+                  **kwargs) -> list:
     r"""
     Return a list of all saved model versions belonging to an organization, app, and model.
 
+    .. note:: For models with many versions, use :func:`iter_versions` to fetch versions lazily, page by page.
+
+    :param limit:
+        *Optional*. Maximum number of model versions to return.
+    :type limit:
+        int
+    :param since_version:
+        *Optional*. Only return model versions newer than this version.
+    :type since_version:
+        int
+    :param since_updated_at:
+        *Optional*. Only return model versions updated after this time.
+    :type since_updated_at:
+        datetime or str (ISO 8601)
+    :param descending:
+        If True, return the newest model versions first. False by default.
+    :type descending:
+        boolean
+    :param index:
+        *Optional*. Local metadata index to record every fetched model version in.
+    :type index:
+        skafos.index.MetadataIndex
     :param \**kwargs:
         Keyword arguments identifying the organization, app, and model for version retrieval. See below.
     :return:
@@ -345,19 +829,26 @@ def list_versions(**kwargs) -> list:
 
     :raises:
         * `InvalidTokenError` - if improper API token is used or is missing entirely.
-        * `InvalidParamError` - if improper connection parameters are passed.
+        * `InvalidParamError` - if improper connection parameters or filters are passed.
 
     """
+    # Concurrent identical listings share a single walk through the pages
     params = _generate_required_params(kwargs)
-    endpoint = "/organizations/{org_name}/apps/{app_name}/models/{model_name}/model_versions?order_by=version".format(**params)
-    res = _http_request(
-        method="GET",
-        url=API_BASE_URL + endpoint,
-        api_token=params["skafos_api_token"]
-    ).json()
-
-    versions = _clean_up_version_list(res)
-    return versions
+    key = ("list_versions", params["skafos_api_token"], params["org_name"], params["app_name"], params["model_name"],
+           limit, since_version, str(since_updated_at), descending, id(index))
+    versions = _inflight.do(
+        key,
+        lambda: list(iter_versions(
+            limit=limit,
+            since_version=since_version,
+            since_updated_at=since_updated_at,
+            descending=descending,
+            index=index,
+            **kwargs
+        ))
+    )
+    # Every caller gets its own copy of the shared result
+    return [dict(version) for version in versions]
 
 def _clean_up_environments_list(res):
     environments = []
@@ -376,9 +867,14 @@ def _clean_up_environments_list(res):
     return environments
 
 
-def list_environments(**kwargs) -> list:
+def list_environments(index=None, **kwargs) -> list:
     r"""
     Return a list of all available environments belonging to an organization, app, and model.
+
+    :param index:
+        *Optional*. Local metadata index to record the fetched environments in.
+    :type index:
+        skafos.index.MetadataIndex
     :param \**kwargs:
         Keyword arguments identifying the organization, app, and model for version retrieval. See below.
     :return:
@@ -419,8 +915,9 @@ def list_environments(**kwargs) -> list:
         api_token=params["skafos_api_token"]
     ).json()
 
-
     environments = _clean_up_environments_list(res)
+    if index is not None:
+        index.add_environments(params["org_name"], params["app_name"], params["model_name"], environments)
 
     return environments
 
@@ -0,0 +1,330 @@
+import os
+import ssl
+import time
+import hashlib
+import logging
+import threading
+import requests
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .http import DOWNLOAD_BASE_URL
+
+
+DEFAULT_PORT = 8950
+DEFAULT_STORE_SIZE = 50 * 1024**3
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".skafos", "peer-cache")
+# Requests without an explicit version resolve to the latest one, so they are only reused briefly
+DEFAULT_LATEST_TTL = 60
+UPSTREAM_TIMEOUT = (5, 300)
+# Seconds a client connection may sit idle, or stall its TLS handshake, before it is dropped
+CLIENT_TIMEOUT = 60
+CHUNK_SIZE = 512*1024
+STORE_SUFFIX = ".skafos-cache"
+# Upstream headers passed on to clients, including digests so they can verify what the cache serves
+RELAYED_HEADERS = ("Content-Type", "Digest", "x-goog-hash", "x-amz-checksum-sha256", "x-amz-checksum-crc32c")
+logger = logging.getLogger(name="skafos.peercache")
+
+
+def _check_url(url):
+    # The peer cache gets the API token with every download, so say so when it would travel in the clear
+    if url and not url.lower().startswith("https://"):
+        logger.warning("Peer cache {} is not HTTPS, so your Skafos API token is sent to it unencrypted".format(url))
+    return url
+
+
+# Peer cache the SDK downloads through, if any
+peer_cache_url = _check_url(os.getenv("SKAFOS_PEER_CACHE_URL"))
+
+
+def configure(url=None):
+    r"""
+    Download model versions through a peer cache on your local network (see `skafos cache-serve`). If the peer
+    cache can't serve a download, the SDK falls back to Skafos. Can also be set from the environment as
+    `SKAFOS_PEER_CACHE_URL`.
+
+    .. note:: Your Skafos API token is sent to the peer cache with every download, so serve it over HTTPS (see
+       :func:`serve`); a warning is logged for any other URL. For a self-signed certificate, point
+       `REQUESTS_CA_BUNDLE` at it. Cached versions are keyed by API token, so nodes using different tokens
+       don't share downloads.
+
+    :param url:
+        Base URL of the peer cache, for example "https://model-cache.local:8950". Pass None to always download
+        from Skafos.
+    :type url:
+        str or None
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import peercache
+
+       peercache.configure(url="https://model-cache.local:8950")
+
+    """
+    global peer_cache_url
+    peer_cache_url = _check_url(url)
+
+
+class _Entry(object):
+    # One model version download, shared by every client asking for it
+    def __init__(self, key, path, expires_at):
+        self.key = key
+        self.path = path
+        self.expires_at = expires_at
+        self.status = None
+        self.headers = {}
+        self.body = b""
+        self.size = 0
+        self.complete = False
+        self.failed = False
+        self.readers = 0
+        self.last_used = time.monotonic()
+        self.condition = threading.Condition()
+
+
+class PeerCache(object):
+    """Size-bounded store of model version downloads. Each version is fetched from upstream once, and
+    streamed to every client that asks for it, even while it is still being fetched."""
+
+    def __init__(self, directory=DEFAULT_STORE_DIR, max_size=DEFAULT_STORE_SIZE, upstream=DOWNLOAD_BASE_URL,
+                 latest_ttl=DEFAULT_LATEST_TTL):
+        self.directory = directory
+        self.max_size = max_size
+        self.upstream = upstream.rstrip("/")
+        self.latest_ttl = latest_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        os.makedirs(directory, exist_ok=True)
+        # The store isn't persisted across restarts, so clear out anything a previous run left behind
+        for name in os.listdir(directory):
+            if name.endswith(STORE_SUFFIX):
+                os.remove(os.path.join(directory, name))
+
+    def open(self, path, token):
+        """Return the entry for a download path, starting the upstream fetch if needed. Callers
+        must :meth:`release` the entry when they are done reading it."""
+        # Keyed by token too, so clients only get versions their token can download
+        key = hashlib.sha256("{}\n{}".format(token, path).encode("utf-8")).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (entry.failed or (entry.expires_at and entry.expires_at < now)):
+                self._drop(entry)
+                entry = None
+            if entry is None:
+                expires_at = None if "version=" in path else now + self.latest_ttl
+                entry = _Entry(key, os.path.join(self.directory, key + STORE_SUFFIX), expires_at)
+                self._entries[key] = entry
+                fetch = threading.Thread(target=self._fetch, args=(entry, path, token), daemon=True)
+                fetch.start()
+            entry.readers += 1
+            entry.last_used = now
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.readers -= 1
+            if entry.readers == 0 and self._entries.get(entry.key) is not entry:
+                self._remove_file(entry)
+        self._evict()
+
+    def _drop(self, entry):
+        # Forget an entry; its file goes once nobody is reading it. Call with the lock held.
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        if entry.readers == 0:
+            self._remove_file(entry)
+
+    @staticmethod
+    def _remove_file(entry):
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _fetch(self, entry, path, token):
+        try:
+            headers = {"X-API-TOKEN": token, "Accept-Encoding": "identity"}
+            with self._session.get(self.upstream + path, headers=headers, stream=True,
+                                   timeout=UPSTREAM_TIMEOUT) as response, open(entry.path, "wb") as f:
+                with entry.condition:
+                    entry.status = response.status_code
+                    entry.headers = {k: response.headers[k] for k in RELAYED_HEADERS if k in response.headers}
+                    if response.status_code != 200:
+                        # Relay errors to waiting clients, but never cache them
+                        entry.body = response.content
+                        entry.failed = True
+                    entry.condition.notify_all()
+                if response.status_code != 200:
+                    return
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    f.flush()
+                    with entry.condition:
+                        entry.size += len(chunk)
+                        entry.condition.notify_all()
+            with entry.condition:
+                entry.complete = True
+                entry.condition.notify_all()
+            logger.info("Cached {} ({} bytes)".format(path.split("?")[0], entry.size))
+        except Exception as err:
+            logger.warning("Fetching {} from upstream failed: {}".format(path, err))
+            with entry.condition:
+                entry.failed = True
+                if entry.status is None:
+                    entry.status = 502
+                entry.condition.notify_all()
+        self._evict()
+
+    def _evict(self):
+        # Drop least recently used complete entries until the store fits in max_size
+        with self._lock:
+            total = sum(entry.size for entry in self._entries.values())
+            idle = sorted(
+                (entry for entry in self._entries.values() if entry.complete and entry.readers == 0),
+                key=lambda entry: entry.last_used
+            )
+            for entry in idle:
+                if total <= self.max_size:
+                    break
+                total -= entry.size
+                self._drop(entry)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so bodies are sent chunked: a response cut short by a failed upstream fetch is then missing its
+    # terminating chunk, which clients report as an error instead of saving a truncated archive
+    protocol_version = "HTTP/1.1"
+    timeout = CLIENT_TIMEOUT
+
+    def setup(self):
+        # Run the TLS handshake on this connection's thread, so a client that never sends one only stalls itself
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.settimeout(self.timeout)
+            self.request.do_handshake()
+        super().setup()
+
+    def do_GET(self):
+        token = self.headers.get("X-API-TOKEN")
+        if not token:
+            self.send_error(401, "Missing Skafos API Token")
+            return
+        cache = self.server.cache
+        entry = cache.open(self.path, token)
+        try:
+            with entry.condition:
+                while entry.status is None:
+                    entry.condition.wait()
+            if entry.status != 200:
+                self.send_response(entry.status)
+                self.send_header("Content-Length", str(len(entry.body)))
+                self.end_headers()
+                self.wfile.write(entry.body)
+                return
+            self.send_response(200)
+            for name, value in entry.headers.items():
+                self.send_header(name, value)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self._stream(entry)
+        finally:
+            cache.release(entry)
+
+    def _stream(self, entry):
+        # Follow the store file as the upstream fetch fills it in
+        sent = 0
+        with open(entry.path, "rb") as f:
+            while True:
+                with entry.condition:
+                    while entry.size <= sent and not entry.complete and not entry.failed:
+                        entry.condition.wait()
+                    available, complete, failed = entry.size, entry.complete, entry.failed
+                if available > sent:
+                    f.seek(sent)
+                    data = f.read(min(available - sent, CHUNK_SIZE))
+                    self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+                    sent += len(data)
+                elif complete:
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                elif failed:
+                    # Close without the terminating chunk so the client sees an incomplete download
+                    self.close_connection = True
+                    return
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s" % (self.address_string(), format % args))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Failed handshakes and dropped clients are routine, so log them rather than printing tracebacks
+        logger.debug("Connection from {} failed".format(client_address[0]), exc_info=True)
+
+
+def make_server(host="0.0.0.0", port=DEFAULT_PORT, directory=DEFAULT_STORE_DIR, max_size=DEFAULT_STORE_SIZE,
+                upstream=DOWNLOAD_BASE_URL, certfile=None, keyfile=None):
+    """Create a peer cache HTTP server, serving HTTPS when given a certificate. Call `serve_forever()` on it
+    to start serving."""
+    server = _Server((host, port), _Handler)
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    elif host not in ("127.0.0.1", "localhost", "::1"):
+        logger.warning("Serving without TLS on {}, so clients' API tokens cross the network unencrypted".format(host))
+    server.cache = PeerCache(directory=directory, max_size=max_size, upstream=upstream)
+    return server
+
+
+def serve(host="0.0.0.0", port=DEFAULT_PORT, directory=DEFAULT_STORE_DIR, max_size=DEFAULT_STORE_SIZE,
+          upstream=DOWNLOAD_BASE_URL, certfile=None, keyfile=None):
+    r"""
+    Run a peer cache for model version downloads on the local network. This is what `skafos cache-serve` runs.
+
+    .. note:: Cached versions are only served to clients presenting the same API token that downloaded them, so
+       fleets that give each node its own token get no deduplication. Clients send their API token with every
+       request: pass `certfile` to serve HTTPS unless the network is trusted.
+
+    :param host:
+        Interface to listen on. Defaults to all interfaces.
+    :type host:
+        str
+    :param port:
+        Port to listen on. Defaults to 8950.
+    :type port:
+        int
+    :param directory:
+        Directory to store cached model versions in. Defaults to `~/.skafos/peer-cache`.
+    :type directory:
+        str
+    :param max_size:
+        Maximum number of bytes to keep in the store. Defaults to 50GB.
+    :type max_size:
+        int
+    :param upstream:
+        Download endpoint to fetch model versions from. Defaults to Skafos.
+    :type upstream:
+        str
+    :param certfile:
+        *Optional*. PEM certificate chain to serve HTTPS with.
+    :type certfile:
+        str
+    :param keyfile:
+        *Optional*. Private key for the certificate, if it isn't in `certfile`.
+    :type keyfile:
+        str
+    """
+    server = make_server(host=host, port=port, directory=directory, max_size=max_size, upstream=upstream,
+                         certfile=certfile, keyfile=keyfile)
+    logger.info("Serving Skafos peer cache on {}:{}".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
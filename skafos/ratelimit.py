@@ -0,0 +1,175 @@
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+
+METADATA = "metadata"
+TRANSFER = "transfer"
+CHUNK = "chunk"
+# Requests per second and burst size for each kind of endpoint, per host
+DEFAULT_METADATA_RATE = 20.0
+DEFAULT_METADATA_BURST = 40
+DEFAULT_TRANSFER_RATE = 5.0
+DEFAULT_TRANSFER_BURST = 10
+# Delta uploads move many small chunks to a chunk store you run, so chunk requests get a far larger allowance
+DEFAULT_CHUNK_RATE = 200.0
+DEFAULT_CHUNK_BURST = 400
+# Never throttle a bucket below this fraction of its configured rate
+MIN_RATE_FRACTION = 0.05
+# Fraction of the configured rate regained after each successful request
+RECOVERY_FRACTION = 0.1
+logger = logging.getLogger(name="skafos.ratelimit")
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that halves its rate on throttling and recovers additively."""
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline=None):
+        # Block until a token is available, or raise once the deadline passes while waiting
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if deadline is not None:
+                wait = min(wait, deadline.remaining())
+            time.sleep(wait)
+
+    def throttle(self, retry_after=None):
+        # Multiplicative decrease, and hold every caller back until the server is ready again
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self._tokens = 0.0
+            if retry_after is None:
+                retry_after = 1 / self.rate
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def recover(self):
+        # Additive increase back towards the configured rate
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+class RateLimiter(object):
+    """Process-wide rate limiter keeping one token bucket per host and endpoint kind."""
+
+    def __init__(self, metadata_rate=DEFAULT_METADATA_RATE, metadata_burst=DEFAULT_METADATA_BURST,
+                 transfer_rate=DEFAULT_TRANSFER_RATE, transfer_burst=DEFAULT_TRANSFER_BURST,
+                 chunk_rate=DEFAULT_CHUNK_RATE, chunk_burst=DEFAULT_CHUNK_BURST):
+        self.limits = {
+            METADATA: (metadata_rate, metadata_burst),
+            TRANSFER: (transfer_rate, transfer_burst),
+            CHUNK: (chunk_rate, chunk_burst)
+        }
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url, kind):
+        rate, burst = self.limits[kind]
+        if not rate:
+            return None
+        key = (urlparse(url).netloc, kind)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(rate, burst)
+            return self._buckets[key]
+
+    def acquire(self, url, kind, deadline=None):
+        bucket = self.bucket(url, kind)
+        if bucket:
+            bucket.acquire(deadline)
+
+    def record(self, url, kind, status_code, retry_after=None):
+        bucket = self.bucket(url, kind)
+        if not bucket:
+            return
+        if status_code == 429:
+            logger.debug("Rate limited by {}, slowing {} requests down".format(urlparse(url).netloc, kind))
+            bucket.throttle(_parse_retry_after(retry_after))
+        elif status_code < 500:
+            bucket.recover()
+
+
+def _parse_retry_after(value):
+    # Only the delay-seconds form of Retry-After is honored
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+rate_limiter = RateLimiter()
+
+
+def configure(metadata_rate=DEFAULT_METADATA_RATE, metadata_burst=DEFAULT_METADATA_BURST,
+              transfer_rate=DEFAULT_TRANSFER_RATE, transfer_burst=DEFAULT_TRANSFER_BURST,
+              chunk_rate=DEFAULT_CHUNK_RATE, chunk_burst=DEFAULT_CHUNK_BURST):
+    r"""
+    Configure the process-wide rate limits shared by every Skafos SDK call. Limits apply per host, with
+    separate buckets for metadata calls, model transfers (uploads and downloads), and chunk store requests
+    made by delta uploads and downloads (see :mod:`skafos.delta`). Buckets slow down
+    automatically when Skafos responds with 429 (Too Many Requests) and recover as requests succeed.
+
+    :param metadata_rate:
+        Sustained metadata requests per second per host. Pass None to disable limiting.
+    :type metadata_rate:
+        float or None
+    :param metadata_burst:
+        Number of metadata requests allowed in a burst.
+    :type metadata_burst:
+        int
+    :param transfer_rate:
+        Sustained upload or download requests per second per host. Pass None to disable limiting.
+    :type transfer_rate:
+        float or None
+    :param transfer_burst:
+        Number of upload or download requests allowed in a burst.
+    :type transfer_burst:
+        int
+    :param chunk_rate:
+        Sustained chunk store requests per second per host. Pass None to disable limiting.
+    :type chunk_rate:
+        float or None
+    :param chunk_burst:
+        Number of chunk store requests allowed in a burst.
+    :type chunk_burst:
+        int
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import ratelimit
+
+       ratelimit.configure(metadata_rate=5, metadata_burst=10)
+
+    """
+    global rate_limiter
+    rate_limiter = RateLimiter(
+        metadata_rate=metadata_rate,
+        metadata_burst=metadata_burst,
+        transfer_rate=transfer_rate,
+        transfer_burst=transfer_burst,
+        chunk_rate=chunk_rate,
+        chunk_burst=chunk_burst
+    )
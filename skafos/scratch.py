@@ -0,0 +1,111 @@
+import os
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(name="skafos.scratch")
+
+# Every scratch directory still in use by this process, removed at interpreter exit
+_active_dirs = set()
+_active_lock = threading.Lock()
+
+
+def _remove(path):
+    shutil.rmtree(path, ignore_errors=True)
+    with _active_lock:
+        _active_dirs.discard(path)
+
+
+@atexit.register
+def _cleanup_active_dirs():
+    with _active_lock:
+        paths = list(_active_dirs)
+    for path in paths:
+        logger.debug("Removing leftover scratch directory {}".format(path))
+        _remove(path)
+
+
+class ScratchSpace(object):
+    """Scratch directories for upload archives, bounded by a per-process disk quota."""
+
+    def __init__(self, directory=None, quota=None):
+        self.directory = directory
+        self.quota = quota
+        self._reserved = 0
+        self._condition = threading.Condition()
+
+    def _reserve(self, size, deadline=None):
+        # Block while the reservation would push us past the quota. A reservation larger than the
+        # whole quota is let through once nothing else is reserved, so it can't wait forever.
+        # Waiting past the deadline raises its Timeout.
+        with self._condition:
+            while self.quota and self._reserved and self._reserved + size > self.quota:
+                logger.debug("Scratch quota reached, waiting for {} bytes".format(size))
+                self._condition.wait(timeout=deadline.remaining() if deadline is not None else None)
+            self._reserved += size
+
+    def _release(self, size):
+        with self._condition:
+            self._reserved -= size
+            self._condition.notify_all()
+
+    @contextmanager
+    def workspace(self, size=0, deadline=None):
+        """Reserve `size` bytes of the quota, waiting until `deadline` at most, and yield a fresh scratch
+        directory. The directory is removed when the block exits, whether it succeeds or fails."""
+        self._reserve(size, deadline)
+        try:
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+            path = tempfile.mkdtemp(prefix="skafos-", dir=self.directory)
+            with _active_lock:
+                _active_dirs.add(path)
+            try:
+                yield path
+            finally:
+                _remove(path)
+        finally:
+            self._release(size)
+
+
+def _quota_from_env():
+    quota = os.getenv("SKAFOS_SCRATCH_QUOTA")
+    return int(quota) if quota else None
+
+
+scratch_space = ScratchSpace(directory=os.getenv("SKAFOS_SCRATCH_DIR"), quota=_quota_from_env())
+
+
+def configure(directory=None, quota=None):
+    r"""
+    Configure where the Skafos SDK writes temporary upload archives and how much disk it may use for them.
+    Defaults are read from the environment as `SKAFOS_SCRATCH_DIR` and `SKAFOS_SCRATCH_QUOTA`.
+
+    Scratch directories are always removed once an upload finishes or fails, and any left over are removed
+    when the interpreter exits.
+
+    :param directory:
+        *Optional*. Directory to create scratch space in, for example a tmpfs mount or a fast local SSD.
+        Defaults to the system temp directory.
+    :type directory:
+        str
+    :param quota:
+        *Optional*. Maximum number of bytes this process may hold in scratch space at once. Uploads that
+        would exceed it wait for others to finish. Unlimited by default.
+    :type quota:
+        int
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import scratch
+
+       scratch.configure(directory="/mnt/fast-ssd/skafos", quota=20 * 1024**3)
+
+    """
+    global scratch_space
+    scratch_space = ScratchSpace(directory=directory, quota=quota)
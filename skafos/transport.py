@@ -0,0 +1,169 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class Transport(object):
+    """Interface for sending prepared requests to Skafos. Subclass this to plug in another HTTP client
+    (or an in-memory stand-in for tests) and install it with :func:`set_transport`."""
+
+    def send(self, prepared, timeout, stream=False):
+        """Send a :class:`requests.PreparedRequest` and return a :class:`requests.Response`. Connection
+        problems and timeouts must be raised as the matching :mod:`requests.exceptions`."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any pooled connections."""
+        pass
+
+
+class RequestsTransport(Transport):
+    """Default HTTP/1.1 transport. A single pooled session is shared by every call, so connections
+    are kept alive and reused across requests and threads."""
+
+    def __init__(self, pool_maxsize=32):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def send(self, prepared, timeout, stream=False):
+        return self._session.send(prepared, timeout=timeout, stream=stream)
+
+    def close(self):
+        self._session.close()
+
+
+def _iter_body(fp, chunk_size):
+    # Read file bodies in fixed-size chunks; httpx would otherwise iterate them line by line
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _StreamReader(object):
+    # File-like view of a streamed httpx response, enough for requests.Response.iter_content
+    def __init__(self, response):
+        self._response = response
+        self._chunks = response.iter_bytes()
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Transport(Transport):
+    r"""
+    HTTP/2 transport that multiplexes concurrent calls to the same host over a single connection.
+    Requires the optional `httpx` dependency: ``pip install skafos[http2]``.
+
+    :param \**client_kwargs:
+        Extra keyword arguments passed to :class:`httpx.Client`.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, **client_kwargs):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("HTTP/2 support requires httpx. Install it with `pip install skafos[http2]`.")
+        self._httpx = httpx
+        self._client = httpx.Client(http2=True, **client_kwargs)
+
+    def send(self, prepared, timeout, stream=False):
+        httpx = self._httpx
+        body = prepared.body
+        if hasattr(body, "read"):
+            body = _iter_body(body, self.CHUNK_SIZE)
+        request = self._client.build_request(
+            prepared.method,
+            prepared.url,
+            headers=dict(prepared.headers),
+            content=body,
+            timeout=self._timeout(timeout)
+        )
+        try:
+            response = self._client.send(request, stream=stream)
+        except httpx.TimeoutException as err:
+            raise requests.exceptions.Timeout(err, request=prepared)
+        except httpx.TransportError as err:
+            raise requests.exceptions.ConnectionError(err, request=prepared)
+        return self._to_requests_response(response, prepared, stream)
+
+    def _timeout(self, timeout):
+        # Requests-style (connect, read) tuples map onto httpx's connect and read timeouts
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self._httpx.Timeout(read, connect=connect)
+        return self._httpx.Timeout(timeout)
+
+    @staticmethod
+    def _to_requests_response(response, prepared, stream):
+        res = requests.Response()
+        res.status_code = response.status_code
+        res.headers = CaseInsensitiveDict(response.headers)
+        res.url = str(response.url)
+        res.reason = response.reason_phrase
+        res.request = prepared
+        if stream:
+            res.raw = _StreamReader(response)
+        else:
+            res._content = response.content
+            res._content_consumed = True
+        return res
+
+    def close(self):
+        self._client.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Return the transport used by every Skafos SDK call, creating the default one if needed."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = RequestsTransport()
+        return _transport
+
+
+def set_transport(transport):
+    r"""
+    Replace the transport used by every Skafos SDK call. The previous transport is closed.
+
+    :param transport:
+        Transport instance to use. Pass None to go back to the default requests-based transport.
+    :type transport:
+        skafos.transport.Transport or None
+
+    :Usage:
+    .. sourcecode:: python
+
+       from skafos import transport
+
+       # Multiplex concurrent metadata calls over HTTP/2
+       transport.set_transport(transport.HTTP2Transport())
+
+    """
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+    if previous is not None and previous is not transport:
+        previous.close()
@@ -1,8 +1,14 @@
 import os
+from collections import namedtuple
+
 from .http import _http_request, API_BASE_URL
 from .exceptions import InvalidTokenError
 
 
+# One model a token can see, as yielded by iter_summary
+ModelRecord = namedtuple("ModelRecord", ["org_name", "app_name", "model_name", "updated_at"])
+
+
 def get_version():
     r"""Returns the current version of the Skafos SDK in use.
 
@@ -28,26 +34,46 @@ def _get_organization_models(org_name, api_token):
     return res
 
 
-def _full_summary(organizations, api_token):
-    summary_res = []
+def _get_organizations(api_token):
+    # Check for api token first, then list every organization it can see
+    if not api_token:
+        api_token = os.getenv("SKAFOS_API_TOKEN")
+    if not api_token:
+        raise InvalidTokenError("Missing Skafos API Token")
+    res = _http_request(
+        method="GET",
+        url=API_BASE_URL + "/organizations",
+        api_token=api_token
+    ).json()
+    return res, api_token
+
+
+def _iter_records(organizations, api_token, index=None):
+    # Yield each organization's models as soon as its apps response arrives
     for org in organizations:
-        org_dict = {"org_name": org["display_name"]}
-        apps = _get_organization_models(org_name=org["display_name"], api_token=api_token)
+        org_name = org["display_name"]
+        apps = _get_organization_models(org_name=org_name, api_token=api_token)
+        if index is not None:
+            index.add_apps(org_name, apps)
         for app in apps:
-            app_dict = org_dict.copy()
-            app_dict["app_name"]= app["name"]
             for model in app["models"]:
-                model_dict = app_dict.copy()
-                model_dict["model_name"] = model["name"]
-                summary_res.append(model_dict)
-    return summary_res
+                yield ModelRecord(org_name, app["name"], model["name"], model.get("updated_at"))
+
 
+def _full_summary(organizations, api_token, index=None):
+    return [
+        {"org_name": record.org_name, "app_name": record.app_name, "model_name": record.model_name}
+        for record in _iter_records(organizations, api_token, index=index)
+    ]
 
-def _compact_summary(organizations, api_token):
+
+def _compact_summary(organizations, api_token, index=None):
     summary_res = {}
     for org in organizations:
         summary_res[org["display_name"]] = {}
         apps = _get_organization_models(org_name=org["display_name"], api_token=api_token)
+        if index is not None:
+            index.add_apps(org["display_name"], apps)
         for app in apps:
             summary_res[org["display_name"]][app["name"]] = []
             for model in app["models"]:
@@ -56,7 +82,7 @@ def _compact_summary(organizations, api_token):
     return summary_res
 
 
-def summary(skafos_api_token=None, compact=False):
+def summary(skafos_api_token=None, compact=False, index=None):
     r"""
     Returns all Skafos organizations, apps, and models that the provided API token has access to.
 
@@ -72,6 +98,11 @@ def summary(skafos_api_token=None, compact=False):
         full response as a list of dictionaries including key names.
     :type compact:
         boolean
+    :param index:
+        *Optional*. Local metadata index to record every organization, app, and model in. Query it later
+        without network access.
+    :type index:
+        skafos.index.MetadataIndex
     :return:
         List or nested dictionary (compact version) of all organizations, apps, and models this user has access to.
 
@@ -89,25 +120,47 @@ def summary(skafos_api_token=None, compact=False):
         * `InvalidTokenError` - if improper API token is used or is missing entirely.
 
     """
-    # Check for api token first
-    if not skafos_api_token:
-        skafos_api_token = os.getenv("SKAFOS_API_TOKEN")
-    if not skafos_api_token:
-        raise InvalidTokenError("Missing Skafos API Token")
-
-    # Prepare requests
-    method = "GET"
-    endpoint = "/organizations"
-    res = _http_request(
-        method=method,
-        url=API_BASE_URL + endpoint,
-        api_token=skafos_api_token
-    ).json()
+    res, skafos_api_token = _get_organizations(skafos_api_token)
 
     if not compact:
-        summary_res = _full_summary(organizations=res, api_token=skafos_api_token)
+        summary_res = _full_summary(organizations=res, api_token=skafos_api_token, index=index)
     else:
-        summary_res = _compact_summary(organizations=res, api_token=skafos_api_token)
+        summary_res = _compact_summary(organizations=res, api_token=skafos_api_token, index=index)
 
     # Return the summary response to the user
     return summary_res
+
+
+def iter_summary(skafos_api_token=None, index=None):
+    r"""
+    Iterate over all Skafos models that the provided API token has access to, one record at a time. Unlike
+    :func:`summary`, records are yielded as soon as each organization's apps arrive, so very large accounts can be
+    processed without waiting for, or holding, the whole summary in memory.
+
+    :param skafos_api_token:
+        Skafos API Token associated with the user account. Checks environment for 'SKAFOS_API_TOKEN' if not passed
+        into the function directly. Get one at https://dashboard.skafos.ai --> Account Settings --> Tokens.
+    :type skafos_api_token:
+        str or None
+    :param index:
+        *Optional*. Local metadata index to record every organization, app, and model in as they are iterated.
+    :type index:
+        skafos.index.MetadataIndex
+    :return:
+        Generator of `ModelRecord` named tuples with `org_name`, `app_name`, `model_name`, and `updated_at` fields.
+
+    :Usage:
+    .. sourcecode:: python
+
+       import skafos
+
+       for record in skafos.iter_summary(skafos_api_token="<YOUR-SKAFOS-API-TOKEN>"):
+           print(record.org_name, record.app_name, record.model_name)
+
+    :raises:
+        * `InvalidTokenError` - if improper API token is used or is missing entirely.
+
+    """
+    # Fetch organizations up front so errors raise before iteration starts
+    res, skafos_api_token = _get_organizations(skafos_api_token)
+    return _iter_records(organizations=res, api_token=skafos_api_token, index=index)
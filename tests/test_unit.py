@@ -5,10 +5,32 @@ All unit tests can be run offline and require no connection to any Skafos backen
 services. They test bits of logic and handlers of backend responses (mocked). Unit
 tests that break should stop a build/deploy in it's tracks.
 """
+import io
+import json
+import math
+import base64
+import hashlib
+import os
+import time
+import random
+import shutil
+import socket
+import subprocess
+import zipfile
+import zlib
+import threading
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import pytest
+import requests
 import skafos
+from skafos import archive, delta, hedging, integrity, peercache, ratelimit, scratch
+import skafos.transport
 from skafos.exceptions import *
-from skafos.http import _generate_required_params
+from skafos.http import _generate_required_params, _http_request, Deadline
+from skafos.transport import Transport
+from skafos import models, utilities
+from skafos.index import MetadataIndex
 from skafos.models import upload_version, _create_filename, _check_description, _check_version, _check_environment
 from constants import *
 
@@ -20,6 +42,97 @@ PARAMS = {
 }
 
 
+class MockResponse(object):
+    # Stand-in for a requests.Response returned by the Skafos API
+    def __init__(self, body=None, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+    def close(self):
+        pass
+
+
+def mock_version_pages(versions, calls, honor_order=True):
+    # Serve a paginated model_versions listing from a list of version numbers
+    def _request(method, url, api_token, **kwargs):
+        calls.append(url)
+        query = dict(q.split("=") for q in url.split("?")[1].split("&"))
+        ordered = sorted(versions, reverse=honor_order and query.get("order") == "desc")
+        page, per_page = int(query["page"]), int(query["per_page"])
+        page_versions = ordered[(page - 1) * per_page:page * per_page]
+        return MockResponse([{"version": v, "name": "test", "updated_at": "2019-06-0{}".format(v % 9 + 1)} for v in page_versions])
+    return _request
+
+
+class MockTransport(Transport):
+    # In-memory transport answering each request with the next queued status code
+    def __init__(self, statuses, body=b"[]", headers=None):
+        self.statuses = list(statuses)
+        self.body = body
+        self.headers = headers or {}
+        self.sent = []
+        self.timeouts = []
+
+    def send(self, prepared, timeout, stream=False):
+        self.sent.append(prepared)
+        self.timeouts.append(timeout)
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.headers["Retry-After"] = "0"
+        response.headers.update(self.headers)
+        response.raw = io.BytesIO(self.body)
+        return response
+
+
+def mock_upload(uploads, headers=None):
+    # Answer the create, upload, and update calls made by upload_version
+    def _request(method, url, api_token, payload=None, header=None, **kwargs):
+        if method == "POST":
+            return MockResponse({"presigned_url": "https://storage.test/upload", "model_version_id": "1", "filepath": "f"})
+        if method == "PUT":
+            uploads.append(payload.read() if hasattr(payload, "read") else payload)
+            if headers is not None:
+                headers.append(header)
+            return MockResponse()
+        return MockResponse({"version": 1, "name": "test", "model": "test"})
+    return _request
+
+
+class SlowOriginHandler(BaseHTTPRequestHandler):
+    # Stand-in for the download endpoint that trickles a model archive out in chunks
+    requests = []
+    body = b"model-bytes" * 10000
+
+    def do_GET(self):
+        SlowOriginHandler.requests.append(self.path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        for i in range(0, len(self.body), 20000):
+            self.wfile.write(self.body[i:i + 20000])
+            time.sleep(0.02)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TruncatedOriginHandler(BaseHTTPRequestHandler):
+    # Stand-in for the download endpoint that drops the connection halfway through a model archive
+    body = b"model-bytes" * 10000
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body[:len(self.body) // 2])
+
+    def log_message(self, format, *args):
+        pass
+
+
 class TestUnit(object):
 
     # Validate that the version returns as a string
@@ -87,3 +200,775 @@ class TestUnit(object):
                 model_name=TESTING_MODEL,
                 **PARAMS
             )
+
+    # Test that iterating versions stops fetching pages once the limit is reached
+    def test_iter_versions_limit(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(models, "_http_request", mock_version_pages(list(range(1, 251)), calls))
+        res = list(models.iter_versions(model_name=TESTING_MODEL, descending=True, limit=3, page_size=10, **PARAMS))
+        assert [v["version"] for v in res] == [250, 249, 248]
+        assert len(calls) == 1
+
+    # Test that iterating versions walks every page and applies the since_version filter
+    def test_iter_versions_since_version(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(models, "_http_request", mock_version_pages(list(range(1, 26)), calls))
+        res = models.list_versions(model_name=TESTING_MODEL, since_version=20, **PARAMS)
+        assert [v["version"] for v in res] == [21, 22, 23, 24, 25]
+
+    # Test that descending order holds when the server ignores the order parameter
+    def test_iter_versions_server_ignores_order(self, monkeypatch):
+        monkeypatch.setattr(models, "_http_request", mock_version_pages(range(1, 51), [], honor_order=False))
+        assert [v["version"] for v in models.iter_versions(model_name=TESTING_MODEL, descending=True, limit=1, **PARAMS)] == [50]
+        monkeypatch.setattr(models, "_http_request", mock_version_pages(range(1, 26), [], honor_order=False))
+        res = models.iter_versions(model_name=TESTING_MODEL, descending=True, page_size=10, **PARAMS)
+        assert [v["version"] for v in res] == list(range(25, 0, -1))
+
+    # Test that versions without an update time are skipped rather than breaking the updated_at filter
+    def test_iter_versions_null_updated_at(self, monkeypatch):
+        monkeypatch.setattr(models, "_http_request", lambda **kwargs: MockResponse([
+            {"version": 1, "name": "test", "updated_at": None}, {"version": 2, "name": "test", "updated_at": "2019-06-02"}
+        ]))
+        res = models.iter_versions(model_name=TESTING_MODEL, since_updated_at="2019-06-01", **PARAMS)
+        assert [v["version"] for v in res] == [2]
+
+    # Test an invalid version filter to make sure error is thrown before iterating
+    def test_iter_versions_invalid_filter(self):
+        with pytest.raises(InvalidParamError):
+            models.iter_versions(model_name=TESTING_MODEL, since_version="1", **PARAMS)
+
+    # Test that summary populates the local index and that it can be queried offline
+    def test_summary_populates_index(self, monkeypatch):
+        apps = {
+            "org-a": [{"name": "app", "models": [{"name": "fresh", "updated_at": "2019-06-13T10:00:00"}]}],
+            "org-b": [{"name": "app", "models": [{"name": "stale", "updated_at": "2019-01-01T10:00:00"}]}]
+        }
+        monkeypatch.setattr(utilities, "_http_request", lambda **kwargs: MockResponse([{"display_name": o} for o in apps]))
+        monkeypatch.setattr(utilities, "_get_organization_models", lambda org_name, api_token: apps[org_name])
+        with MetadataIndex(":memory:") as index:
+            skafos.summary(skafos_api_token=TESTING_FAKE_TOKEN, index=index)
+            res = index.models(updated_since="2019-06-12")
+            assert [m["model_name"] for m in res] == ["fresh"]
+            assert len(index.models()) == 2
+
+    # Test that iter_summary yields each organization's models before fetching the next organization
+    def test_iter_summary_streams(self, monkeypatch):
+        apps = {
+            "org-a": [{"name": "app", "models": [{"name": "first", "updated_at": "2019-06-13T10:00:00"}]}],
+            "org-b": [{"name": "app", "models": [{"name": "second"}]}]
+        }
+        fetched = []
+        monkeypatch.setattr(utilities, "_http_request", lambda **kwargs: MockResponse([{"display_name": o} for o in apps]))
+        monkeypatch.setattr(utilities, "_get_organization_models",
+                            lambda org_name, api_token: fetched.append(org_name) or apps[org_name])
+        records = skafos.iter_summary(skafos_api_token=TESTING_FAKE_TOKEN)
+        first = next(records)
+        assert fetched == ["org-a"]
+        assert first == utilities.ModelRecord("org-a", "app", "first", "2019-06-13T10:00:00")
+        assert [r.model_name for r in records] == ["second"]
+        assert skafos.summary(skafos_api_token=TESTING_FAKE_TOKEN)[1] == {"org_name": "org-b", "app_name": "app", "model_name": "second"}
+
+    # Test that iter_summary raises a missing token as soon as it is called
+    def test_iter_summary_missing_token(self, monkeypatch):
+        monkeypatch.delenv("SKAFOS_API_TOKEN", raising=False)
+        with pytest.raises(InvalidTokenError):
+            skafos.iter_summary()
+
+    # Test that listed versions are recorded in the local index
+    def test_list_versions_populates_index(self, monkeypatch):
+        monkeypatch.setattr(models, "_http_request", mock_version_pages([1, 2, 3], []))
+        with MetadataIndex(":memory:") as index:
+            models.list_versions(model_name=TESTING_MODEL, index=index, **PARAMS)
+            assert [v["version"] for v in index.versions(model_name=TESTING_MODEL)] == [1, 2, 3]
+            assert len(index.models(version=2)) == 1
+
+    # Test that a throttled token bucket slows down and recovers towards its configured rate
+    def test_token_bucket_adapts(self):
+        bucket = ratelimit.TokenBucket(rate=10, burst=1)
+        bucket.throttle(retry_after=0)
+        assert bucket.rate == 5
+        bucket.recover()
+        assert bucket.rate == 6
+
+    # Test that a 429 response is retried through the rate limiter
+    def test_http_request_retries_429(self, monkeypatch):
+        transport = MockTransport([429, 200])
+        monkeypatch.setattr(ratelimit, "rate_limiter", ratelimit.RateLimiter())
+        monkeypatch.setattr(skafos.transport, "_transport", transport)
+        res = _http_request(method="GET", url="https://api.skafos.test/v2/organizations", api_token=TESTING_FAKE_TOKEN)
+        assert res.status_code == 200
+        assert len(transport.sent) == 2
+
+    # Test uploading a mapping of in-memory buffers, zipped without touching disk
+    def test_upload_in_memory_buffers(self, monkeypatch):
+        uploads = []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads))
+        files = {"weights.bin": memoryview(b"0123456789"), "labels.txt": io.BytesIO(b"cat\ndog")}
+        upload_version(files=files, model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        with zipfile.ZipFile(io.BytesIO(uploads[0])) as archive:
+            assert archive.read("weights.bin") == b"0123456789"
+            assert archive.read("labels.txt") == b"cat\ndog"
+
+    # Test that invalid in-memory files are rejected before a model version record is created
+    def test_upload_invalid_buffers_create_nothing(self, monkeypatch):
+        uploads, calls = [], []
+        upload = mock_upload(uploads)
+        monkeypatch.setattr(models, "_http_request", lambda method, url, api_token, **kwargs: calls.append(method) or upload(method, url, api_token, **kwargs))
+        with pytest.raises(InvalidParamError):
+            upload_version(files={"a.bin": 123}, model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert calls == []
+
+    # Test that an in-memory zip named after the model is uploaded as is
+    def test_upload_in_memory_zip(self, monkeypatch):
+        uploads = []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads))
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as skazip:
+            skazip.writestr("model.mlmodel", b"model")
+        upload_version(files={TESTING_MODEL + ".zip": archive.getvalue()}, model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert uploads[0] == archive.getvalue()
+
+    # Test that an uploaded archive carries a Content-MD5 of the bytes sent, only once it is enabled
+    def test_upload_sends_content_md5(self, monkeypatch, tmp_path):
+        uploads, headers = [], []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads, headers))
+        (tmp_path / "weights.bin").write_bytes(b"weights" * 1000)
+        upload_version(files=str(tmp_path / "weights.bin"), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert "Content-MD5" not in headers[0]
+        monkeypatch.setattr(integrity, "content_md5", True)
+        upload_version(files=str(tmp_path / "weights.bin"), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert headers[1]["Content-MD5"] == base64.b64encode(hashlib.md5(uploads[1]).digest()).decode("ascii")
+        with zipfile.ZipFile(io.BytesIO(uploads[0])) as skazip:
+            assert skazip.testzip() is None
+
+    # Test that a prebuilt zip is streamed as it is, without an extra pass to digest it
+    def test_upload_prebuilt_zip_single_pass(self, monkeypatch, tmp_path):
+        uploads, headers = [], []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads, headers))
+        monkeypatch.setattr(integrity, "file_digests", None)
+        monkeypatch.chdir(tmp_path)
+        with zipfile.ZipFile(TESTING_MODEL + ".zip", "w") as skazip:
+            skazip.writestr("model.mlmodel", b"model")
+        upload_version(files=TESTING_MODEL + ".zip", model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert "Content-MD5" not in headers[0]
+        assert uploads[0] == (tmp_path / (TESTING_MODEL + ".zip")).read_bytes()
+
+    # Test that uploading files leaves nothing behind in scratch space, even when the upload fails
+    def test_upload_cleans_scratch(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(scratch, "scratch_space", scratch.ScratchSpace(directory=str(tmp_path / "scratch")))
+        model_file = tmp_path / "model.mlmodel"
+        model_file.write_bytes(b"model")
+        uploads = []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads))
+        upload_version(files=str(model_file), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert len(uploads) == 1
+        assert os.listdir(str(tmp_path / "scratch")) == []
+        monkeypatch.setattr(models, "_http_request", lambda **kwargs: MockResponse({}))
+        with pytest.raises(UploadFailedError):
+            upload_version(files=str(model_file), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert os.listdir(str(tmp_path / "scratch")) == []
+
+    # Test that scratch reservations past the quota wait for space to be released
+    def test_scratch_quota_backpressure(self, tmp_path):
+        space = scratch.ScratchSpace(directory=str(tmp_path), quota=100)
+        events = []
+
+        def reserve():
+            with space.workspace(size=60):
+                events.append("second")
+
+        with space.workspace(size=60):
+            waiter = threading.Thread(target=reserve)
+            waiter.start()
+            time.sleep(0.1)
+            events.append("first")
+        waiter.join()
+        assert events == ["first", "second"]
+
+    # Test that the upload deadline also bounds waiting for scratch quota
+    def test_upload_deadline_bounds_scratch_wait(self, monkeypatch, tmp_path):
+        space = scratch.ScratchSpace(directory=str(tmp_path / "scratch"), quota=1)
+        monkeypatch.setattr(scratch, "scratch_space", space)
+        monkeypatch.setattr(models, "_http_request", mock_upload([]))
+        model_file = tmp_path / "model.mlmodel"
+        model_file.write_bytes(b"model")
+        start = time.monotonic()
+        with space.workspace(size=1):
+            with pytest.raises(requests.exceptions.Timeout):
+                upload_version(files=str(model_file), model_name=TESTING_MODEL, verbose=False, deadline=0.3, **PARAMS)
+        assert time.monotonic() - start < 2
+
+    # Test that the model version record isn't created while the upload waits for scratch quota
+    def test_upload_waits_for_scratch_before_record(self, monkeypatch, tmp_path):
+        space = scratch.ScratchSpace(directory=str(tmp_path / "scratch"), quota=1)
+        monkeypatch.setattr(scratch, "scratch_space", space)
+        methods = []
+        upload = mock_upload([])
+
+        def request(method, **kwargs):
+            methods.append(method)
+            return upload(method, **kwargs)
+
+        monkeypatch.setattr(models, "_http_request", request)
+        for name in ["a.txt", "b.txt"]:
+            (tmp_path / name).write_bytes(b"model")
+        with space.workspace(size=1):
+            with pytest.raises(requests.exceptions.Timeout):
+                upload_version(files=[str(tmp_path / "a.txt"), str(tmp_path / "b.txt")], model_name=TESTING_MODEL,
+                               verbose=False, deadline=0.3, **PARAMS)
+        assert methods == []
+
+    # Test that packaging stops early when creating the model version record fails
+    def test_upload_stops_packaging_on_record_error(self, monkeypatch, tmp_path):
+        def request(method, **kwargs):
+            raise InvalidTokenError("Invalid Skafos API Token")
+
+        written = []
+
+        def write_member(skazip, entry):
+            written.append(entry.arcname)
+            time.sleep(0.05)
+
+        monkeypatch.setattr(models, "_http_request", request)
+        monkeypatch.setattr(archive, "_write_member", write_member)
+        files = []
+        for i in range(20):
+            (tmp_path / "{}.txt".format(i)).write_bytes(b"model")
+            files.append(str(tmp_path / "{}.txt".format(i)))
+        with pytest.raises(InvalidTokenError):
+            upload_version(files=files, model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert len(written) < 5
+
+    # Test that scanning lists directories concurrently in the order os.walk would, and validates inputs
+    def test_scan_matches_walk(self, tmp_path):
+        for folder in ["model/a/b", "model/a/c", "model/d"]:
+            (tmp_path / folder).mkdir(parents=True)
+            for i in range(3):
+                (tmp_path / folder / "file{}.txt".format(i)).write_bytes(b"x" * i)
+        (tmp_path / "extra.bin").write_bytes(b"extra")
+        inputs = [str(tmp_path / "model"), str(tmp_path / "extra.bin")]
+        walked = [os.path.join(root, name) for root, _, names in os.walk(inputs[0]) for name in names] + [inputs[1]]
+        manifest = archive.scan(inputs, workers=4)
+        assert [entry.path for entry in manifest] == walked
+        assert [entry.size for entry in manifest] == [os.stat(path).st_size for path in walked]
+        (tmp_path / "broken.zip").write_bytes(b"not a zip")
+        with pytest.raises(InvalidParamError):
+            archive.scan([str(tmp_path / "broken.zip")])
+        with pytest.raises(InvalidParamError):
+            archive.scan([str(tmp_path / "missing")])
+
+    # Test that the archive cache reuses identical trees and splices unchanged members into new archives
+    def test_archive_cache_splices_members(self, tmp_path):
+        cache = archive.ArchiveCache(str(tmp_path / "cache"))
+        model_dir = tmp_path / "model"
+        model_dir.mkdir()
+        (model_dir / "weights.bin").write_bytes(b"weights" * 1000)
+        (model_dir / "labels.txt").write_bytes(b"labels")
+        first, digests = cache.archive(archive.build_manifest([str(model_dir)]))
+        reused, reused_digests = cache.archive(archive.build_manifest([str(model_dir)]))
+        assert reused == first and reused_digests.to_dict() == digests.to_dict()
+        (model_dir / "labels.txt").write_bytes(b"new labels")
+        second, digests = cache.archive(archive.build_manifest([str(model_dir)]))
+        assert second != first
+        assert digests.to_dict() == integrity.file_digests(second, archive.ARCHIVE_DIGESTS).to_dict()
+        with zipfile.ZipFile(second) as skazip:
+            assert skazip.testzip() is None
+            contents = {os.path.basename(name): skazip.read(name) for name in skazip.namelist()}
+        assert contents == {"weights.bin": b"weights" * 1000, "labels.txt": b"new labels"}
+
+    # Test that the archive cache falls back to compressing when zipfile lacks the internals splicing needs
+    def test_archive_cache_without_splice_support(self, monkeypatch, tmp_path):
+        cache = archive.ArchiveCache(str(tmp_path / "cache"))
+        model_dir = tmp_path / "model"
+        model_dir.mkdir()
+        (model_dir / "weights.bin").write_bytes(b"weights" * 1000)
+        cache.archive(archive.build_manifest([str(model_dir)]))
+        (model_dir / "labels.txt").write_bytes(b"labels")
+        members = os.listdir(str(tmp_path / "cache" / "members"))
+        old = time.time() - 3600
+        for name in members:
+            os.utime(str(tmp_path / "cache" / "members" / name), (old, old))
+        monkeypatch.setattr(archive, "_SPLICE_ATTRIBUTES", archive._SPLICE_ATTRIBUTES + ("_no_such_internal",))
+        path, _ = cache.archive(archive.build_manifest([str(model_dir)]))
+        with zipfile.ZipFile(path) as skazip:
+            assert skazip.testzip() is None
+            assert sorted(os.path.basename(name) for name in skazip.namelist()) == ["labels.txt", "weights.bin"]
+        monkeypatch.undo()
+        (model_dir / "extra.txt").write_bytes(b"extra")
+        cache.archive(archive.build_manifest([str(model_dir)]))
+        assert all(os.stat(str(tmp_path / "cache" / "members" / name)).st_mtime > old for name in members)
+
+    # Test that the model version record is created while the archive is being packaged
+    def test_upload_creates_record_while_packaging(self, monkeypatch, tmp_path):
+        created = threading.Event()
+        uploads = []
+        upload = mock_upload(uploads)
+
+        def request(method, url, api_token, **kwargs):
+            if method == "POST":
+                created.set()
+            return upload(method, url, api_token, **kwargs)
+
+        def zip_archive(name, manifest, directory):
+            assert created.wait(timeout=5)
+            return archive.write_archive(os.path.join(directory, name), manifest)
+
+        monkeypatch.setattr(models, "_http_request", request)
+        monkeypatch.setattr(models, "_zip_archive", zip_archive)
+        model_file = tmp_path / "model.mlmodel"
+        model_file.write_bytes(b"model")
+        upload_version(files=str(model_file), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert len(uploads) == 1
+
+    # Test that a packaging failure abandons the record without uploading to it
+    def test_upload_packaging_failure_abandons_record(self, monkeypatch, tmp_path):
+        methods = []
+        upload = mock_upload([])
+
+        def request(method, url, api_token, **kwargs):
+            methods.append(method)
+            return upload(method, url, api_token, **kwargs)
+
+        def zip_archive(name, manifest, directory):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(models, "_http_request", request)
+        monkeypatch.setattr(models, "_zip_archive", zip_archive)
+        model_file = tmp_path / "model.mlmodel"
+        model_file.write_bytes(b"model")
+        with pytest.raises(OSError):
+            upload_version(files=str(model_file), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+        assert "PUT" not in methods and "PATCH" not in methods
+
+    # Test that concurrent fetches of the same version share one download and all get its path
+    def test_fetch_version_coalesced(self, monkeypatch, tmp_path):
+        monkeypatch.chdir(tmp_path)
+        calls = []
+
+        def download(method, url, api_token, stream=False, **kwargs):
+            calls.append(url)
+            time.sleep(0.2)
+            with open(TESTING_MODEL + ".zip", "wb") as f:
+                f.write(b"model")
+            return MockResponse()
+
+        monkeypatch.setattr(models, "_http_request", download)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(models.fetch_version(model_name=TESTING_MODEL, **PARAMS)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == [TESTING_MODEL + ".zip"] * 5
+
+    # Test that fetches through a shared cache download a version once and then reuse it
+    def test_fetch_version_shared_cache(self, monkeypatch, tmp_path):
+        calls = []
+
+        def download(method, url, api_token, stream=False, filename=None, **kwargs):
+            calls.append(url)
+            with open(filename, "wb") as f:
+                f.write(b"model")
+            return MockResponse()
+
+        monkeypatch.setattr(models, "_http_request", download)
+        cache_dir = str(tmp_path / "cache")
+        first = models.fetch_version(version=3, cache_dir=cache_dir, model_name=TESTING_MODEL, **PARAMS)
+        second = models.fetch_version(version=3, cache_dir=cache_dir, model_name=TESTING_MODEL, **PARAMS)
+        assert first == second
+        assert first.endswith(os.path.join(TESTING_MODEL, "3.zip"))
+        assert len(calls) == 1
+        assert [name for name in os.listdir(os.path.dirname(first)) if name.endswith(".tmp")] == []
+
+    # Test that processes fetching the same version at once download it once, clearing crashed downloads first
+    def test_fetch_version_shared_cache_across_processes(self, monkeypatch, tmp_path):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            pytest.skip("needs fork to share the mocked download with child processes")
+        log = str(tmp_path / "downloads.log")
+
+        def download(method, url, api_token, stream=False, filename=None, **kwargs):
+            with open(log, "a") as f:
+                f.write(url + "\n")
+            time.sleep(0.3)
+            with open(filename, "wb") as f:
+                f.write(b"model")
+            return MockResponse()
+
+        monkeypatch.setattr(models, "_http_request", download)
+        cache_dir = str(tmp_path / "cache")
+        cache_path = os.path.join(cache_dir, TESTING_ORG, TESTING_APP, TESTING_MODEL, "3.zip")
+        os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path + ".99999.tmp", "wb") as f:
+            f.write(b"partial")
+        context = multiprocessing.get_context("fork")
+        fetches = [context.Process(target=models.fetch_version, kwargs=dict(
+            version=3, cache_dir=cache_dir, model_name=TESTING_MODEL, **PARAMS)) for _ in range(4)]
+        for fetch in fetches:
+            fetch.start()
+        for fetch in fetches:
+            fetch.join()
+        assert [fetch.exitcode for fetch in fetches] == [0] * 4
+        with open(log) as f:
+            assert len(f.readlines()) == 1
+        with open(cache_path, "rb") as f:
+            assert f.read() == b"model"
+        assert [name for name in os.listdir(os.path.dirname(cache_path)) if name.endswith(".tmp")] == []
+
+    # Test that metadata calls get their own connect/read timeouts and are clamped to the deadline
+    def test_http_request_timeouts(self, monkeypatch):
+        transport = MockTransport([200, 200])
+        monkeypatch.setattr(skafos.transport, "_transport", transport)
+        _http_request(method="GET", url="https://api.skafos.test/v2/organizations", api_token=TESTING_FAKE_TOKEN)
+        assert transport.timeouts[0] == skafos.http.DEFAULT_METADATA_TIMEOUT
+        _http_request(method="GET", url="https://api.skafos.test/v2/organizations", api_token=TESTING_FAKE_TOKEN,
+                      deadline=Deadline(1))
+        assert all(t <= 1 for t in transport.timeouts[1])
+
+    # Test that waiting out a 429 never runs past the deadline
+    def test_http_request_deadline_bounds_retry_after(self, monkeypatch):
+        monkeypatch.setattr(ratelimit, "rate_limiter", ratelimit.RateLimiter())
+        transport = MockTransport([429, 200], headers={"Retry-After": "3"})
+        monkeypatch.setattr(skafos.transport, "_transport", transport)
+        start = time.monotonic()
+        with pytest.raises(requests.exceptions.Timeout):
+            _http_request(method="GET", url="https://api.skafos.test/v2/organizations", api_token=TESTING_FAKE_TOKEN,
+                          deadline=Deadline(0.5))
+        assert time.monotonic() - start < 1.5
+        assert len(transport.sent) == 1
+
+    # Test that a streamed request body is cut off once the deadline passes
+    def test_http_request_deadline_bounds_body(self, monkeypatch):
+        class SlowUploadTransport(MockTransport):
+            def send(self, prepared, timeout, stream=False):
+                while prepared.body.read(10):
+                    time.sleep(0.1)
+                return super().send(prepared, timeout, stream)
+
+        monkeypatch.setattr(skafos.transport, "_transport", SlowUploadTransport([200]))
+        with pytest.raises(requests.exceptions.Timeout):
+            _http_request(method="PUT", url="https://storage.skafos.test/upload", api_token=TESTING_FAKE_TOKEN,
+                          payload=io.BytesIO(b"x" * 100), deadline=Deadline(0.3))
+
+    # Test that an expired deadline stops a request before it is sent
+    def test_http_request_deadline_exceeded(self, monkeypatch):
+        transport = MockTransport([200])
+        monkeypatch.setattr(skafos.transport, "_transport", transport)
+        with pytest.raises(requests.exceptions.Timeout):
+            _http_request(method="GET", url="https://api.skafos.test/v2/organizations", api_token=TESTING_FAKE_TOKEN,
+                          deadline=Deadline(0))
+        assert transport.sent == []
+
+    # Test that a download not matching its advertised digest fails and is removed
+    def test_download_digest_mismatch(self, monkeypatch, tmp_path):
+        filename = str(tmp_path / "model.zip")
+        good = base64.b64encode(hashlib.sha256(b"model").digest()).decode("ascii")
+        transport = MockTransport([200, 200], body=b"model", headers={"Digest": "sha-256=" + good})
+        monkeypatch.setattr(skafos.transport, "_transport", transport)
+        response = _http_request(method="GET", url=skafos.http.DOWNLOAD_BASE_URL + "/models/test", api_token=TESTING_FAKE_TOKEN,
+                                 stream=True, filename=filename)
+        assert response.digests.hexdigest("sha256") == hashlib.sha256(b"model").hexdigest()
+        transport.body = b"tampered"
+        with pytest.raises(DownloadFailedError):
+            _http_request(method="GET", url=skafos.http.DOWNLOAD_BASE_URL + "/models/test", api_token=TESTING_FAKE_TOKEN,
+                          stream=True, filename=filename)
+        assert not os.path.exists(filename)
+
+    # Test that chunk boundaries follow content, so an insertion only changes the chunks around it
+    def test_iter_chunks_content_defined(self):
+        data = random.Random(7).randbytes(300000)
+        sizes = {"min_size": 2048, "avg_size": 8192, "max_size": 32768}
+        chunks = list(delta.iter_chunks(io.BytesIO(data), **sizes))
+        assert b"".join(chunks) == data
+        assert all(len(chunk) <= sizes["max_size"] for chunk in chunks)
+        edited = list(delta.iter_chunks(io.BytesIO(data[:100000] + b"inserted" + data[100000:]), **sizes))
+        assert len(set(edited) - set(chunks)) <= 2
+
+    # Test that the numpy chunker cuts at exactly the same points as the pure Python one
+    def test_vectorized_cut_point_matches(self):
+        pytest.importorskip("numpy")
+        rng = random.Random(11)
+        for min_size, avg_size, max_size in [(16, 64, 256), (2048, 8192, 32768), (100000, 300000, 400000)]:
+            bits = round(math.log2(avg_size - min_size))
+            mask = ((1 << bits) - 1) << (64 - bits)
+            for _ in range(10):
+                data = rng.randbytes(rng.randint(0, max_size + 100))
+                assert delta._cut_point_vectorized(data, min_size, max_size, mask) == \
+                    delta._cut_point(data, min_size, max_size, mask)
+
+    # Test that chunk index entries expire, so chunks the store lost are checked again
+    def test_chunk_index_expires(self, monkeypatch):
+        index = delta.ChunkIndex(":memory:", max_age=60)
+        index.add("store", ["a", "b"])
+        assert index.known("store", ["a", "b", "c"]) == {"a", "b"}
+        now = time.time()
+        monkeypatch.setattr(delta.time, "time", lambda: now + 61)
+        assert index.known("store", ["a", "b"]) == set()
+        index.add("store", ["a"])
+        assert index.known("store", ["a", "b"]) == {"a"}
+        index.close()
+
+    # Test that a delta upload only sends changed chunks and that fetching reassembles the archive
+    def test_delta_upload_round_trip(self, monkeypatch, tmp_path):
+        server = delta.make_server(str(tmp_path / "chunks"), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        store = delta.ChunkStore("http://127.0.0.1:{}".format(server.server_address[1]), index=delta.ChunkIndex(":memory:"),
+                                 min_size=1024, avg_size=4096, max_size=16384)
+        monkeypatch.setattr(delta, "chunk_store", store)
+        # Default limits: chunk requests must not queue behind the transfer bucket
+        monkeypatch.setattr(ratelimit, "rate_limiter", ratelimit.RateLimiter())
+        uploads = []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads))
+        model_dir = tmp_path / "model"
+        model_dir.mkdir()
+        weights = bytearray(random.Random(3).randbytes(200000))
+        try:
+            (model_dir / "weights.bin").write_bytes(weights)
+            (model_dir / "labels.txt").write_bytes(b"cat\ndog")
+            upload_version(files=str(model_dir), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+            stored = len(os.listdir(str(tmp_path / "chunks")))
+            weights[150000:150004] = b"edit"
+            (model_dir / "weights.bin").write_bytes(weights)
+            upload_version(files=str(model_dir), model_name=TESTING_MODEL, verbose=False, **PARAMS)
+            assert 0 < len(os.listdir(str(tmp_path / "chunks"))) - stored <= 2
+
+            def download(method, url, api_token, filename=None, **kwargs):
+                with open(filename, "wb") as f:
+                    f.write(uploads[1])
+                return MockResponse()
+
+            monkeypatch.chdir(tmp_path)
+            monkeypatch.setattr(models, "_http_request", download)
+            models.fetch_version(version=2, model_name=TESTING_MODEL, **PARAMS)
+            assert {kind for _, kind in ratelimit.rate_limiter._buckets} == {ratelimit.CHUNK}
+        finally:
+            server.shutdown()
+            server.server_close()
+        with zipfile.ZipFile(str(tmp_path / (TESTING_MODEL + ".zip"))) as skazip:
+            contents = {os.path.basename(name): skazip.read(name) for name in skazip.namelist()}
+        assert contents == {"weights.bin": bytes(weights), "labels.txt": b"cat\ndog"}
+
+    # Test that in-memory uploads are chunked too when delta uploads are enabled
+    def test_delta_upload_in_memory(self, monkeypatch, tmp_path):
+        server = delta.make_server(str(tmp_path / "chunks"), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        store = delta.ChunkStore("http://127.0.0.1:{}".format(server.server_address[1]), index=delta.ChunkIndex(":memory:"),
+                                 min_size=1024, avg_size=4096, max_size=16384)
+        monkeypatch.setattr(delta, "chunk_store", store)
+        uploads = []
+        monkeypatch.setattr(models, "_http_request", mock_upload(uploads))
+        weights = random.Random(5).randbytes(50000)
+        labels = io.BytesIO(b"cat\ndog")
+        try:
+            upload_version(files={"weights.bin": weights, "labels.txt": labels}, model_name=TESTING_MODEL,
+                           verbose=False, **PARAMS)
+            assert not labels.closed
+            assert uploads[0].startswith(delta._MAGIC)
+
+            def download(method, url, api_token, filename=None, **kwargs):
+                with open(filename, "wb") as f:
+                    f.write(uploads[0])
+                return MockResponse()
+
+            monkeypatch.chdir(tmp_path)
+            monkeypatch.setattr(models, "_http_request", download)
+            models.fetch_version(version=1, model_name=TESTING_MODEL, **PARAMS)
+        finally:
+            server.shutdown()
+            server.server_close()
+        with zipfile.ZipFile(str(tmp_path / (TESTING_MODEL + ".zip"))) as skazip:
+            assert {name: skazip.read(name) for name in skazip.namelist()} == {"weights.bin": weights,
+                                                                                "labels.txt": b"cat\ndog"}
+
+    # Test that the stand-in chunk store only accepts chunk digests and chunks matching their digest
+    def test_chunk_server_validates_digests(self, tmp_path):
+        server = delta.make_server(str(tmp_path / "chunks"), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/chunks/".format(server.server_address[1])
+        headers = {"X-API-TOKEN": "t"}
+        digest = hashlib.sha256(b"chunk").hexdigest()
+        try:
+            res = requests.post(url + "missing", data=json.dumps(["/etc/passwd"]), headers=headers)
+            assert res.status_code == 400
+            res = requests.put(url + digest, data=zlib.compress(b"poison"), headers=headers)
+            assert res.status_code == 400
+            assert requests.get(url + digest, headers=headers).status_code == 404
+            res = requests.put(url + digest, data=zlib.compress(b"chunk"), headers=headers)
+            assert res.status_code == 200
+            assert requests.post(url + "missing", data=json.dumps([digest]), headers=headers).json() == []
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Test that a slow request is hedged and the faster response wins
+    def test_hedged_request(self):
+        hedger = hedging.Hedger(min_delay=0.01, max_extra_load=1)
+        for _ in range(hedging.MIN_SAMPLES):
+            hedger._record("api.skafos.test", 0.01)
+        delays = [1, 0]
+        lock = threading.Lock()
+
+        def send():
+            with lock:
+                delay = delays.pop(0)
+            time.sleep(delay)
+            return MockResponse(delay)
+
+        start = time.monotonic()
+        res = hedger.call("https://api.skafos.test/v2/organizations", send)
+        assert res.json() == 0
+        assert time.monotonic() - start < 0.5
+
+    # Test that hedging doesn't cap concurrent calls at the hedge pool size
+    def test_hedging_does_not_queue_calls(self):
+        hedger = hedging.Hedger(min_delay=5, max_workers=2)
+        for _ in range(hedging.MIN_SAMPLES):
+            hedger._record("api.skafos.test", 0.01)
+
+        def send():
+            time.sleep(0.3)
+            return MockResponse()
+
+        start = time.monotonic()
+        calls = [threading.Thread(target=hedger.call, args=("https://api.skafos.test/v2/organizations", send))
+                 for _ in range(8)]
+        for call in calls:
+            call.start()
+        for call in calls:
+            call.join()
+        assert time.monotonic() - start < 0.6
+
+    # Test that the hedge budget only counts recent requests, so a quiet period doesn't bank hedges
+    def test_hedging_budget_is_windowed(self):
+        hedger = hedging.Hedger(max_extra_load=0.5)
+        for _ in range(100):
+            hedger._count_request(time.monotonic() - 2 * hedging.BUDGET_WINDOW)
+        assert not hedger._allow_hedge()
+        for _ in range(4):
+            hedger._count_request(time.monotonic())
+        assert [hedger._allow_hedge() for _ in range(3)] == [True, True, False]
+
+    # Test that HTTP2Transport streams file bodies in fixed-size chunks and converts httpx responses
+    def test_http2_transport(self):
+        httpx = pytest.importorskip("httpx")
+        pytest.importorskip("h2")
+        received, reads = [], []
+
+        class Body(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        def handler(request):
+            received.append(request.read())
+            return httpx.Response(201, headers={"ETag": "abc"}, content=b"x" * 100000)
+
+        transport = skafos.transport.HTTP2Transport(transport=httpx.MockTransport(handler))
+        body = b"line\n" * 50000
+        prepared = requests.Request("PUT", "https://storage.test/upload", data=Body(body)).prepare()
+        res = transport.send(prepared, timeout=(1, 5))
+        assert received == [body]
+        assert set(reads) == {transport.CHUNK_SIZE}
+        assert res.status_code == 201
+        assert res.headers["etag"] == "abc"
+        assert res.content == b"x" * 100000
+        prepared = requests.Request("GET", "https://storage.test/download").prepare()
+        res = transport.send(prepared, timeout=5, stream=True)
+        assert b"".join(res.iter_content(4096)) == b"x" * 100000
+        res.close()
+        transport.close()
+
+    # Test that the peer cache fetches a version from upstream once while streaming it to every client
+    def test_peer_cache_serves_concurrent_clients(self, tmp_path):
+        SlowOriginHandler.requests = []
+        origin = HTTPServer(("127.0.0.1", 0), SlowOriginHandler)
+        threading.Thread(target=origin.serve_forever, daemon=True).start()
+        peer = peercache.make_server(host="127.0.0.1", port=0, directory=str(tmp_path),
+                                     upstream="http://127.0.0.1:{}/v2".format(origin.server_address[1]))
+        threading.Thread(target=peer.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/organizations/o/apps/a/models/m?version=1".format(peer.server_address[1])
+        bodies = []
+        clients = [
+            threading.Thread(target=lambda: bodies.append(requests.get(url, headers={"X-API-TOKEN": "t"}).content))
+            for _ in range(3)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        peer.shutdown()
+        origin.shutdown()
+        assert bodies == [SlowOriginHandler.body] * 3
+        assert SlowOriginHandler.requests == ["/v2/organizations/o/apps/a/models/m?version=1"]
+
+    # Test that a client sees an error, not a short archive, when the peer cache's upstream fetch breaks off
+    def test_peer_cache_truncated_upstream(self, tmp_path):
+        origin = HTTPServer(("127.0.0.1", 0), TruncatedOriginHandler)
+        threading.Thread(target=origin.serve_forever, daemon=True).start()
+        peer = peercache.make_server(host="127.0.0.1", port=0, directory=str(tmp_path),
+                                     upstream="http://127.0.0.1:{}/v2".format(origin.server_address[1]))
+        threading.Thread(target=peer.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/organizations/o/apps/a/models/m?version=1".format(peer.server_address[1])
+        try:
+            response = requests.get(url, headers={"X-API-TOKEN": "t"}, timeout=3, stream=True)
+            # Chunked framing makes the cut detectable even by clients that don't enforce Content-Length
+            assert response.headers["Transfer-Encoding"] == "chunked"
+            with pytest.raises(requests.exceptions.ChunkedEncodingError):
+                response.content
+        finally:
+            peer.shutdown()
+            origin.shutdown()
+
+    # Test that the peer cache serves HTTPS when given a certificate, and that plain HTTP URLs are flagged
+    def test_peer_cache_tls(self, tmp_path, caplog):
+        if shutil.which("openssl") is None:
+            pytest.skip("openssl is not installed")
+        cert, key = str(tmp_path / "cache.pem"), str(tmp_path / "cache.key")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj",
+                        "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", cert],
+                       check=True, capture_output=True)
+        SlowOriginHandler.requests = []
+        origin = HTTPServer(("127.0.0.1", 0), SlowOriginHandler)
+        threading.Thread(target=origin.serve_forever, daemon=True).start()
+        peer = peercache.make_server(host="127.0.0.1", port=0, directory=str(tmp_path / "store"),
+                                     upstream="http://127.0.0.1:{}/v2".format(origin.server_address[1]),
+                                     certfile=cert, keyfile=key)
+        threading.Thread(target=peer.serve_forever, daemon=True).start()
+        # A client that connects and never starts its handshake must not hold up anyone else
+        stalled = socket.create_connection(peer.server_address)
+        url = "https://127.0.0.1:{}/organizations/o/apps/a/models/m?version=1".format(peer.server_address[1])
+        body = requests.get(url, headers={"X-API-TOKEN": "t"}, verify=cert, timeout=3).content
+        stalled.close()
+        peer.shutdown()
+        origin.shutdown()
+        assert body == SlowOriginHandler.body
+        try:
+            peercache.configure(url="http://model-cache.local:8950")
+            assert "not HTTPS" in caplog.text
+            caplog.clear()
+            peercache.configure(url="https://model-cache.local:8950")
+            assert "not HTTPS" not in caplog.text
+        finally:
+            peercache.configure(url=None)
+
+    # Test that downloads fall back to Skafos when the peer cache fails
+    def test_fetch_version_peer_cache_fallback(self, monkeypatch, tmp_path):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(peercache, "peer_cache_url", "http://peer-cache.test:8950")
+        urls = []
+
+        def download(method, url, api_token, filename=None, **kwargs):
+            urls.append(url)
+            if url.startswith("http://peer-cache.test"):
+                raise requests.exceptions.ConnectionError("peer cache is down")
+            with open(filename, "wb") as f:
+                f.write(b"PK")
+            return MockResponse()
+
+        monkeypatch.setattr(models, "_http_request", download)
+        models.fetch_version(model_name=TESTING_MODEL, **PARAMS)
+        assert urls[0].startswith("http://peer-cache.test:8950/organizations/")
+        assert urls[1].startswith(models.DOWNLOAD_BASE_URL)